@@ -1,7 +1,12 @@
 from __future__ import unicode_literals
 import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from django.contrib.auth.models import User
 from django.conf import settings
+from django import db
+from django.db import IntegrityError, transaction
 from rest_framework.authentication import (
     SessionAuthentication, TokenAuthentication
 )
@@ -11,10 +16,22 @@ from social_django.models import UserSocialAuth
 import globus_sdk
 
 import api
+import api.cache
 import api.exc
+import api.http
+import api.transfer
 
 
 log = logging.getLogger(__name__)
+# Introspections currently running in this process, see introspect_globus_token
+_introspections = api.cache.SingleFlight()
+_auth_client = None
+_auth_client_key = None
+_auth_client_lock = threading.Lock()
+_refresh_executor = None
+_refresh_executor_pid = None
+_refresh_executor_lock = threading.Lock()
+_refreshing = set()
 
 
 class IsOwner(permissions.BasePermission):
@@ -46,8 +63,72 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
 
 
 def get_auth_client():
-    return globus_sdk.ConfidentialAppAuthClient(settings.GLOBUS_KEY,
-                                                settings.GLOBUS_SECRET)
+    """Return the process wide Globus Auth client. It is shared by every
+    introspection, dependent token fetch and revocation, and keeps its
+    connections alive in the shared pool from api.http. Requests time out
+    after settings.GLOBUS_AUTH_HTTP_TIMEOUT seconds."""
+    global _auth_client, _auth_client_key
+    key = (os.getpid(), settings.GLOBUS_KEY, settings.GLOBUS_SECRET)
+    with _auth_client_lock:
+        if _auth_client is None or _auth_client_key != key:
+            # globus_sdk<3 takes the timeout directly, later versions take
+            # it as a transport parameter.
+            if int(globus_sdk.__version__.split('.')[0]) < 3:
+                kwargs = {'http_timeout': settings.GLOBUS_AUTH_HTTP_TIMEOUT}
+            else:
+                kwargs = {'transport_params': {'http_timeout': settings.GLOBUS_AUTH_HTTP_TIMEOUT}}
+            _auth_client = globus_sdk.ConfidentialAppAuthClient(settings.GLOBUS_KEY,
+                                                                settings.GLOBUS_SECRET, **kwargs)
+            api.http.share_connection_pool(_auth_client)
+            _auth_client_key = key
+        return _auth_client
+
+
+def schedule_dependent_token_refresh(token_id):
+    """Refresh a token's dependent tokens in a background thread, unless a
+    refresh for it is already running in this process."""
+    with _refresh_executor_lock:
+        if token_id in _refreshing:
+            return
+        _refreshing.add(token_id)
+    try:
+        _get_refresh_executor().submit(_run_refresh, token_id)
+    except Exception:
+        with _refresh_executor_lock:
+            _refreshing.discard(token_id)
+        raise
+
+
+def refresh_dependent_tokens(token_id):
+    """Refresh and save the dependent tokens for a ConciergeToken"""
+    ctoken = api.models.ConciergeToken.objects.select_related('user').get(pk=token_id)
+    ctoken.refresh_dependent_tokens()
+    # Cached copies still hold the old tokens
+    api.cache.get_token_cache().delete(token_id)
+    log.debug(f'Refreshed dependent tokens for {ctoken.user}')
+
+
+def _run_refresh(token_id):
+    try:
+        refresh_dependent_tokens(token_id)
+    except Exception as e:
+        log.exception(e)
+    finally:
+        with _refresh_executor_lock:
+            _refreshing.discard(token_id)
+        # Background threads get their own db connection, don't leak it
+        db.connection.close()
+
+
+def _get_refresh_executor():
+    global _refresh_executor, _refresh_executor_pid
+    with _refresh_executor_lock:
+        if _refresh_executor is None or _refresh_executor_pid != os.getpid():
+            _refresh_executor = ThreadPoolExecutor(
+                max_workers=settings.GLOBUS_DEPENDENT_TOKEN_REFRESH_WORKERS,
+                thread_name_prefix='dependent-token-refresh')
+            _refresh_executor_pid = os.getpid()
+        return _refresh_executor
 
 
 def get_or_create_user(token_details):
@@ -63,16 +144,22 @@ def get_or_create_user(token_details):
     try:
         return UserSocialAuth.objects.get(uid=token_details['sub']).user
     except UserSocialAuth.DoesNotExist:
-        name = token_details['name'].split(' ', 1)
-        first_name, last_name = name if len(name) > 1 else (name, '')
-        user = User(username=token_details['username'],
-                    first_name=first_name, last_name=last_name,
-                    email=token_details['email'])
-        user.save()
-        usa = UserSocialAuth(user=user, provider='globus',
-                             uid=token_details['sub'])
-        usa.save()
-        return user
+        pass
+    name = token_details['name'].split(' ', 1)
+    first_name, last_name = name if len(name) > 1 else (name, '')
+    try:
+        with transaction.atomic():
+            user = User(username=token_details['username'],
+                        first_name=first_name, last_name=last_name,
+                        email=token_details['email'])
+            user.save()
+            usa = UserSocialAuth(user=user, provider='globus',
+                                 uid=token_details['sub'])
+            usa.save()
+            return user
+    except IntegrityError:
+        # Another request created the user at the same time
+        return UserSocialAuth.objects.get(uid=token_details['sub']).user
 
 
 def introspect_globus_token(raw_token):
@@ -87,10 +174,37 @@ def introspect_globus_token(raw_token):
     will be raised.
 
     A valid token for first time use will result in user creation based on the
-    uuid 'sub' field on the token data. """
+    uuid 'sub' field on the token data.
+
+    Tokens within their introspection window are also kept in memory (see
+    api.cache.TokenCache), so they are trusted without a database lookup.
+
+    Only one introspection runs at a time per token. Concurrent requests
+    with the same token wait for it and share its result, whether they are
+    in this process or (with settings.GLOBUS_TOKEN_CACHE_SHARED) in other
+    workers."""
+    token_cache = api.cache.get_token_cache()
+    ctoken = token_cache.get(raw_token)
+    if ctoken is not None:
+        return ctoken
+    return _introspections.do(token_cache.key(raw_token),
+                              lambda: _introspect_once(raw_token, token_cache))
+
+
+def _introspect_once(raw_token, token_cache):
+    with token_cache.lock(raw_token):
+        # Another worker may have finished introspecting while we waited
+        ctoken = token_cache.get(raw_token)
+        if ctoken is not None:
+            return ctoken
+        return _introspect(raw_token, token_cache)
+
+
+def _introspect(raw_token, token_cache):
     try:
-        ctoken = api.models.ConciergeToken.objects.get(pk=raw_token)
+        ctoken = api.models.ConciergeToken.objects.select_related('user').get(pk=raw_token)
         if not ctoken.introspection_cache_expired:
+            token_cache.set(ctoken)
             return ctoken
         if ctoken.token_expired:
             raise api.exc.TokenExpired(f'Token expired for user {ctoken.user}')
@@ -102,8 +216,12 @@ def introspect_globus_token(raw_token):
         token_details = ac.oauth2_token_introspect(raw_token).data
         if token_details['active'] is False:
             log.debug('Auth failed, token is not active.')
+            api.transfer.evict_transfer_clients(raw_token)
+            token_cache.delete(raw_token)
             raise api.exc.TokenInactive('Introspection revealed inactive '
                                         'token.')
+        refreshing = False
+        # Save the token only once, after its dependent tokens are cached
         if not ctoken:
             user = get_or_create_user(token_details)
             log.debug(f'Creating new Concierge Token for {user}')
@@ -113,10 +231,25 @@ def introspect_globus_token(raw_token):
                 issued_at=token_details['iat'],
                 scope=token_details['scope']
             )
-        ctoken.reset_introspection_cache()
-        # Ensure dependent tokens are cached
-        ctoken.get_cached_dependent_tokens()
-        ctoken.save()
+            ctoken.reset_introspection_cache(save=False)
+            ctoken.get_cached_dependent_tokens(save=False)
+            try:
+                with transaction.atomic():
+                    ctoken.save(force_insert=True)
+            except IntegrityError:
+                # Created by another worker in the meantime, use theirs
+                ctoken = api.models.ConciergeToken.objects.select_related('user').get(pk=raw_token)
+        else:
+            # Only save the introspection time, a background refresh may be
+            # saving newer dependent tokens at the same time
+            ctoken.reset_introspection_cache(save=False)
+            ctoken.save(update_fields=['last_introspection'])
+            refreshing = ctoken.dependent_tokens_expiring
+            ctoken.get_cached_dependent_tokens()
+        # Don't cache old dependent tokens which a background refresh is
+        # about to replace
+        if not refreshing:
+            token_cache.set(ctoken)
         log.debug(f'Auth Successful for user {ctoken.user}')
         return ctoken
     except globus_sdk.exc.AuthAPIError as ae:
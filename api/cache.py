@@ -0,0 +1,287 @@
+"""
+Process local caches shared by the Concierge Service.
+"""
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+log = logging.getLogger(__name__)
+
+
+class LRUCache(object):
+    """A thread safe LRU cache bounded by size, with optional expiration.
+
+    By default each entry has a size of one, so ``maxsize`` is the number of
+    entries. Pass ``sizeof`` to bound the cache by some other measure, such
+    as bytes. Entries larger than ``maxsize`` are never stored. ``ttl`` is
+    the default number of seconds entries live, and may be overridden per
+    entry when calling set().
+    """
+
+    def __init__(self, maxsize, ttl=None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        # key -> (value, size, expires_at)
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[2] is not None and \
+                    entry[2] < time.time():
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            if size > self.maxsize:
+                log.debug(f'Not caching {key}, size {size} > {self.maxsize}')
+                return
+            expires_at = time.time() + ttl if ttl is not None else None
+            self._data[key] = (value, size, expires_at)
+            self.size += size
+            while self.size > self.maxsize:
+                self._pop(next(iter(self._data)))
+                self.evictions += 1
+
+    def keys(self):
+        with self._lock:
+            return list(self._data)
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self._data),
+                'size': self.size}
+
+    def _pop(self, key):
+        _, size, _ = self._data.pop(key)
+        self.size -= size
+
+
+class ListingCache(object):
+    """Cache for Globus 'operation_ls' results, keyed by (identity, endpoint,
+    path).
+
+    Listings live for ``ttl`` seconds in a process local LRU, and optionally
+    in a shared Django cache (``shared``) so listings can be reused across
+    workers. A listing can be stored along with the directory's
+    last_modified time as reported in its parent's listing. Lookups which
+    pass a different last_modified time treat the entry as stale, so changes
+    to a directory are picked up as soon as its parent is listed again.
+
+    Endpoint permissions are per identity, so each identity (the user id of
+    the ConciergeToken used to list) only ever sees its own listings.
+    """
+
+    def __init__(self, ttl, maxsize, shared=None):
+        self.ttl = ttl
+        # Size listings by their number of entries, so a few huge directories
+        # can't pin down an unbounded amount of memory
+        self.local = LRUCache(maxsize, ttl=ttl,
+                              sizeof=lambda e: len(e['ls_info'].get('DATA', ())) + 1)
+        self.shared = caches[shared] if shared else None
+
+    @staticmethod
+    def key(identity, endpoint, path):
+        digest = hashlib.sha1(f'{identity}:{endpoint}:{path}'.encode('utf-8')).hexdigest()
+        return f'concierge:ls:{digest}'
+
+    def get(self, identity, endpoint, path, mtime=None):
+        key = self.key(identity, endpoint, path)
+        entry = self.local.get(key)
+        if entry is None and self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not None:
+                self.local.set(key, entry,
+                               ttl=max(entry['expires_at'] - time.time(), 0))
+        if entry is None:
+            return None
+        if mtime is not None and entry['mtime'] != mtime:
+            log.debug(f'Listing for {endpoint}:{path} changed, refetching')
+            self.local.delete(key)
+            return None
+        return entry['ls_info']
+
+    def set(self, identity, endpoint, path, ls_info, mtime=None):
+        key = self.key(identity, endpoint, path)
+        entry = {'ls_info': ls_info, 'mtime': mtime,
+                 'expires_at': time.time() + self.ttl}
+        self.local.set(key, entry)
+        if self.shared is not None:
+            self.shared.set(key, entry, timeout=self.ttl)
+
+
+class SingleFlight(object):
+    """Coalesce concurrent calls for the same key. While a call for a key is
+    running, other threads calling do() with that key wait for it and get
+    its result (or exception) instead of making the call themselves."""
+
+    class Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = self.error = None
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class TokenCache(object):
+    """Cache of recently introspected ConciergeTokens, keyed by a hash of
+    the raw token.
+
+    Tokens live in a process local LRU, and optionally in a shared Django
+    cache (``shared``), until their introspection window
+    (settings.GLOBUS_INTROSPECTION_CACHE_EXPIRATION) closes or the token
+    expires, whichever comes first. Cached tokens can be trusted without
+    checking the database or Globus Auth.
+    """
+
+    def __init__(self, maxsize, shared=None):
+        self.local = LRUCache(maxsize)
+        self.shared = caches[shared] if shared else None
+
+    @staticmethod
+    def key(raw_token):
+        digest = hashlib.sha256(raw_token.encode('utf-8')).hexdigest()
+        return f'concierge:token:{digest}'
+
+    def get(self, raw_token):
+        key = self.key(raw_token)
+        ctoken = self.local.get(key)
+        if ctoken is None and self.shared is not None:
+            ctoken = self.shared.get(key)
+            if ctoken is not None:
+                self.local.set(key, ctoken, ttl=self.get_ttl(ctoken))
+        return ctoken
+
+    def set(self, ctoken):
+        ttl = self.get_ttl(ctoken)
+        if ttl <= 0:
+            return
+        key = self.key(ctoken.id)
+        self.local.set(key, ctoken, ttl=ttl)
+        if self.shared is not None:
+            self.shared.set(key, ctoken, timeout=ttl)
+
+    def delete(self, raw_token):
+        key = self.key(raw_token)
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(key)
+
+    @contextlib.contextmanager
+    def lock(self, raw_token):
+        """Hold a lock on raw_token across workers sharing the shared cache,
+        for up to settings.GLOBUS_INTROSPECTION_LOCK_TIMEOUT seconds. Waiting
+        stops early if the token shows up in the cache. Without a shared
+        cache this does nothing."""
+        if self.shared is None:
+            yield
+            return
+        key = f'{self.key(raw_token)}:lock'
+        timeout = settings.GLOBUS_INTROSPECTION_LOCK_TIMEOUT
+        deadline = time.time() + timeout
+        acquired = self.shared.add(key, os.getpid(), timeout=timeout)
+        while not acquired and time.time() < deadline and self.get(raw_token) is None:
+            time.sleep(0.05)
+            acquired = self.shared.add(key, os.getpid(), timeout=timeout)
+        try:
+            yield
+        finally:
+            if acquired:
+                self.shared.delete(key)
+
+    @staticmethod
+    def get_ttl(ctoken):
+        window_end = ctoken.last_introspection + settings.GLOBUS_INTROSPECTION_CACHE_EXPIRATION
+        return min(window_end, ctoken.expires_at) - time.time()
+
+
+_listing_cache = None
+_listing_cache_lock = threading.Lock()
+
+
+def get_listing_cache():
+    """Return the process wide ListingCache, or None if listing caching is
+    disabled by settings.GLOBUS_LS_CACHE_TTL."""
+    global _listing_cache
+    if not settings.GLOBUS_LS_CACHE_TTL:
+        return None
+    with _listing_cache_lock:
+        if _listing_cache is None:
+            _listing_cache = ListingCache(settings.GLOBUS_LS_CACHE_TTL,
+                                          settings.GLOBUS_LS_CACHE_MAX_ENTRIES,
+                                          shared=settings.GLOBUS_LS_CACHE_SHARED)
+        return _listing_cache
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """Return the process wide TokenCache"""
+    global _token_cache
+    with _token_cache_lock:
+        if _token_cache is None:
+            _token_cache = TokenCache(settings.GLOBUS_TOKEN_CACHE_SIZE,
+                                      shared=settings.GLOBUS_TOKEN_CACHE_SHARED)
+        return _token_cache
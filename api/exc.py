@@ -32,6 +32,18 @@ class GlobusTransferException(ConciergeException):
     default_code = 'globus_error'
 
 
+class InvalidGlobusURL(ConciergeException):
+    default_status_code = status.HTTP_400_BAD_REQUEST
+    default_detail = 'Unable to parse Globus URL'
+    default_code = 'invalid_globus_url'
+
+
+class ManifestUnavailable(ConciergeException):
+    default_status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'This manifest is still being stored, try again shortly'
+    default_code = 'manifest_unavailable'
+
+
 class ServiceAuthException(ConciergeException):
     default_status_code = status.HTTP_403_FORBIDDEN
     default_detail = 'A Concierge subservice was unable to authenticate with '\
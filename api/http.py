@@ -0,0 +1,47 @@
+"""
+Shared HTTP connection pools for Globus SDK clients.
+
+Each Globus SDK client has its own requests session. Mounting one adapter
+on all of them lets every client in the process share a single pool of
+keep-alive connections to Globus, instead of each opening its own.
+"""
+import os
+import logging
+import threading
+
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+_adapter = None
+_adapter_pid = None
+_adapter_lock = threading.Lock()
+
+
+def get_http_adapter():
+    """Return the process wide HTTPAdapter, sized by
+    settings.GLOBUS_HTTP_POOL_CONNECTIONS (hosts) and
+    settings.GLOBUS_HTTP_POOL_MAXSIZE (connections per host)."""
+    global _adapter, _adapter_pid
+    with _adapter_lock:
+        if _adapter is None or _adapter_pid != os.getpid():
+            _adapter = HTTPAdapter(pool_connections=settings.GLOBUS_HTTP_POOL_CONNECTIONS,
+                                   pool_maxsize=settings.GLOBUS_HTTP_POOL_MAXSIZE)
+            _adapter_pid = os.getpid()
+        return _adapter
+
+
+def share_connection_pool(client):
+    """Mount the shared adapter on a Globus SDK client's session, and return
+    the client."""
+    # globus_sdk<3 keeps the session on the client, later versions on the
+    # client's transport.
+    session = getattr(client, '_session', None)
+    if session is None:
+        session = getattr(getattr(client, 'transport', None), 'session', None)
+    if session is None:
+        log.warning(f'Unable to share connections for {client}, no session found')
+        return client
+    session.mount('https://', get_http_adapter())
+    return client
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import api.poller
+
+
+class Command(BaseCommand):
+    help = ('Keep the status of Globus transfers up to date. Runs until '
+            'stopped, unless --once is given.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=settings.TRANSFER_POLL_TICK,
+                            help='Seconds between checks for transfers which are due to be polled')
+        parser.add_argument('--once', action='store_true',
+                            help='Poll all transfers which are due, then exit')
+
+    def handle(self, *args, **options):
+        api.poller.run(interval=options['interval'], once=options['once'])
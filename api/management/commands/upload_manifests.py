@@ -0,0 +1,31 @@
+import logging
+from django.core.management.base import BaseCommand
+
+import api.manifest
+import api.staging
+from api.models import Manifest
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Upload manifests staged on this node which never finished '
+            'uploading to S3, for example after a restart.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--include-active', action='store_true',
+                            help='Also retry uploads marked as in progress. Only use this when no '
+                                 'other process on this node is uploading.')
+
+    def handle(self, *args, **options):
+        states = [Manifest.UPLOAD_PENDING, Manifest.UPLOAD_FAILED]
+        if options['include_active']:
+            states.append(Manifest.UPLOAD_ACTIVE)
+        cache = api.staging.get_staging_cache()
+        for manifest_id in Manifest.objects.filter(upload_state__in=states).values_list('id', flat=True):
+            if not cache.is_pinned(manifest_id):
+                # Staged on another node
+                continue
+            self.stdout.write(f'Uploading manifest {manifest_id}')
+            if not api.manifest.upload_manifest(manifest_id):
+                self.stderr.write(f'Failed to upload manifest {manifest_id}')
@@ -1,12 +1,40 @@
 import os
+import gzip
+import hashlib
 import json
 import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import botocore.exceptions
+from django import db
 from django.conf import settings
+from django.db import models, transaction
+import api.cache
+import api.exc
+import api.models
 import api.s3
+import api.staging
+import api.transfer
 
 log = logging.getLogger(__name__)
 
+# Stored manifests are written in the version 2 format below. Version 1
+# manifests (plain JSON) are still readable.
+MANIFEST_FORMAT = 'concierge.remote_file_manifest'
+MANIFEST_VERSION = 2
+GZIP_MAGIC = b'\x1f\x8b'
+# Checksums used for Globus manifest items, in order of preference
+CHECKSUM_PRECEDENCE = ('sha512', 'sha256', 'sha1', 'md5')
+
+_manifest_cache = None
+_manifest_cache_lock = threading.Lock()
+_upload_executor = None
+_upload_executor_pid = None
+_upload_executor_lock = threading.Lock()
+
 # def download_bag(url):
 #     """Given a URL, download an archived bag and return the path where it has
 #     been downloaded."""
@@ -46,35 +74,46 @@ def download_manifest(url):
     # return local_archive
 
 
-def rfm_to_gm(remote_file_manifest):
-    manifest = []
+def get_checksum_precedence():
+    """Supported checksum algorithms, strongest first"""
+    return tuple(alg for alg in CHECKSUM_PRECEDENCE if alg in settings.SUPPORTED_CHECKSUMS)
+
+
+def iter_rfm_to_gm(remote_file_manifest):
+    """Lazily convert remote file manifest entries to Globus manifest items.
+    Items get the strongest supported checksum present on the entry."""
+    precedence = get_checksum_precedence()
     for rfm in remote_file_manifest:
-        hashes = [{'algorithm': k, 'value': v} for k, v in rfm.items()
-                  if k in settings.SUPPORTED_CHECKSUMS]
-        precedence = ['sha512', 'sha256', 'sha1', 'md5']
-        hashes.sort(key=lambda x: precedence.index(x['algorithm']))
         ent = {'source_ref': rfm['url'], 'dest_path': rfm['filename']}
-        if hashes:
-            ent['checksum'] = hashes[0]
-        manifest.append(ent)
-    return manifest
-
+        for algorithm in precedence:
+            if algorithm in rfm:
+                ent['checksum'] = {'algorithm': algorithm, 'value': rfm[algorithm]}
+                break
+        yield ent
 
-def gm_to_rfm(manifest_items):
 
-    rfm = []
+def iter_gm_to_rfm(manifest_items):
+    """Lazily convert Globus manifest items to remote file manifest entries"""
     for man_item in manifest_items:
         rfme = {'url': man_item['source_ref'],
                 'length': 0,
                 'filename': man_item['dest_path']}
-        if man_item.get('checksum'):
-            rfme[man_item['checksum']['algorithm']] = man_item['checksum']['value']
-        rfm.append(rfme)
-    return rfm
+        checksum = man_item.get('checksum')
+        if checksum:
+            rfme[checksum['algorithm']] = checksum['value']
+        yield rfme
+
+
+def rfm_to_gm(remote_file_manifest):
+    return list(iter_rfm_to_gm(remote_file_manifest))
+
+
+def gm_to_rfm(manifest_items):
+    return list(iter_gm_to_rfm(manifest_items))
 
 
 def get_globus_manifest(key):
-    return rfm_to_gm(get_remote_file_manifest(str(key)))
+    return rfm_to_gm(get_remote_file_manifest(key))
 
 
 # def get_remote_file_manifest(location):
@@ -96,20 +135,231 @@ def get_globus_manifest(key):
 #     return entries
 
 def get_remote_file_manifest(key):
-    local_file = api.s3.get_local_file(str(key))
-    if os.path.exists(local_file):
+    """Return the full list of entries for a manifest. Manifests never change
+    once created, so parsed manifests are kept in an in process LRU cache.
+    The returned list is shared with the cache and must not be modified."""
+    key = str(key)
+    cache = get_manifest_cache()
+    remote_file_manifest = cache.get(key)
+    if remote_file_manifest is None:
+        remote_file_manifest = list(read_remote_file_manifest(get_local_manifest(key)))
+        cache.set(key, remote_file_manifest)
+    return remote_file_manifest
+
+
+def get_local_manifest(key):
+    """Return the path to a stored manifest in the local staging cache,
+    downloading it from S3 first if needed."""
+    local_file = api.staging.get_staging_cache().lookup(key)
+    if local_file:
         log.info(f'Using Cached local resource {key}')
-    else:
-        log.warning('Downloads are not ever cleared! Disk space may run out one day!')
-        local_file = api.s3.download(str(key))
-    with open(local_file) as f:
-        return json.load(f)['remote_file_manifest']
+        return local_file
+    try:
+        return api.s3.download(str(key))
+    except botocore.exceptions.ClientError:
+        # Manifests are only readable on the node which created them
+        # until the background upload completes.
+        if api.models.Manifest.objects.filter(id=key).exclude(
+                upload_state=api.models.Manifest.UPLOAD_SUCCEEDED).exists():
+            raise api.exc.ManifestUnavailable()
+        raise
+
+
+def iter_transfer_items(key):
+    """Return an iterator of Globus manifest items for transferring a stored
+    manifest. Stored entries were validated when the manifest was created,
+    so they are converted directly without another serializer pass. The
+    manifest is fetched up front, so any errors fetching it are raised here
+    rather than part way through submitting a transfer."""
+    return _iter_transfer_items(open_remote_file_manifest(key))
+
+
+def open_remote_file_manifest(key):
+    """Return an iterator of a stored manifest's entries, downloading it from
+    S3 first if it isn't in the local staging cache. Entries are read one at
+    a time, so the full manifest is never held in memory (except for legacy
+    version 1 manifests, which are a single JSON document). The manifest is
+    fetched before this returns, so any errors fetching it are raised here
+    rather than while reading. Cached manifests are served from memory, and
+    small manifests are added to the parsed manifest cache once they have
+    been read in full."""
+    key = str(key)
+    entries = get_manifest_cache().get(key)
+    if entries is not None:
+        return iter(entries)
+    return _iter_and_cache(key, read_remote_file_manifest(get_local_manifest(key)))
+
+
+def _iter_and_cache(key, entries):
+    """Yield entries, and cache them once all have been read if there are no
+    more than settings.MANIFEST_CACHE_MAX_ENTRIES"""
+    collected = []
+    for entry in entries:
+        if collected is not None:
+            collected.append(entry)
+            if len(collected) > settings.MANIFEST_CACHE_MAX_ENTRIES:
+                collected = None
+        yield entry
+    if collected is not None:
+        get_manifest_cache().set(key, collected)
+
+
+def _iter_transfer_items(entries):
+    for item in iter_rfm_to_gm(entries):
+        # Entries store parsed URLs, but parse any which don't
+        if isinstance(item['source_ref'], str):
+            item['source_ref'] = api.transfer.parse_globus_url(item['source_ref'])
+        yield item
+
+
+def get_etag(key, fmt, encoding='identity', fields=()):
+    """Return a strong ETag for a manifest rendered in the given format and
+    content encoding, with the given serializer fields. Manifest entries
+    never change, and the serializers for streamed manifests only render
+    fields which never change either (id and user). The field names are
+    included so a change to the representation gets a new ETag."""
+    digest = hashlib.sha1(f'{key}:{fmt}:{encoding}:{",".join(fields)}'.encode('utf-8')).hexdigest()
+    return f'"{digest}"'
+
+
+def get_manifest_cache():
+    """Return the process wide cache of parsed manifests, bounded by
+    settings.MANIFEST_CACHE_MAX_SIZE in settings.MANIFEST_CACHE_SIZE_UNIT
+    ('entries' or approximate 'bytes' in memory)."""
+    global _manifest_cache
+    with _manifest_cache_lock:
+        if _manifest_cache is None:
+            sizeof = _sizeof if settings.MANIFEST_CACHE_SIZE_UNIT == 'bytes' else len
+            _manifest_cache = api.cache.LRUCache(settings.MANIFEST_CACHE_MAX_SIZE, sizeof=sizeof)
+        return _manifest_cache
+
+
+def invalidate_manifest(key):
+    """Drop a manifest from the parsed manifest cache."""
+    get_manifest_cache().delete(str(key))
+
+
+def _sizeof(remote_file_manifest):
+    """Approximate memory used by a parsed manifest, in bytes"""
+    size = sys.getsizeof(remote_file_manifest)
+    for entry in remote_file_manifest:
+        size += sys.getsizeof(entry)
+        for value in entry.values():
+            size += sys.getsizeof(value)
+            if isinstance(value, dict):
+                size += sum(sys.getsizeof(v) for v in value.values())
+    return size
+
+
+def read_remote_file_manifest(filename):
+    """Yield entries from a local manifest file in any supported format.
+
+    Version 2 manifests are gzipped, newline delimited JSON. The first line
+    is a header with the format name and version, followed by one remote
+    file manifest entry per line. Version 1 manifests are a single JSON
+    document: {"remote_file_manifest": [...]}"""
+    with open(filename, 'rb') as f:
+        magic = f.read(len(GZIP_MAGIC))
+    if magic != GZIP_MAGIC:
+        with open(filename) as f:
+            yield from json.load(f)['remote_file_manifest']
+        return
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        header = json.loads(f.readline())
+        if header.get('format') != MANIFEST_FORMAT or \
+                header.get('version') != MANIFEST_VERSION:
+            raise ValueError(f'Unsupported manifest {filename}: {header}')
+        for line in f:
+            yield json.loads(line)
+
+
+def write_remote_file_manifest(filename, remote_file_manifest):
+    """Write entries from any iterable to a local manifest file in the
+    current (version 2) format. The file is written under a temporary name
+    and synced to disk before it is moved into place, so readers never see
+    a partial manifest."""
+    header = {'format': MANIFEST_FORMAT, 'version': MANIFEST_VERSION}
+    tmp_file = f'{filename}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_file, 'wb') as raw:
+            with gzip.open(raw, 'wt', encoding='utf-8',
+                           compresslevel=settings.MANIFEST_COMPRESSION_LEVEL) as f:
+                f.write(json.dumps(header) + '\n')
+                for entry in remote_file_manifest:
+                    f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            # Until the upload completes this is the only copy of the
+            # manifest, make sure it survives a crash.
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_file, filename)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
 
 def upload_remote_file_manifest(key, remote_file_manifest):
-    data = {'remote_file_manifest': remote_file_manifest}
-    filename = os.path.join(settings.AWS_STAGING_DIR, str(key))
-    log.debug(f'Writing manifest to temp dir {filename}')
-    with open(filename, 'w') as f:
-        f.write(json.dumps(data))
-    return api.s3.upload(filename)
+    """Store a new manifest. The manifest is written to the local staging
+    cache, where it can be read immediately, and pinned there until it has
+    been uploaded to S3. The upload runs in the background after the current
+    transaction commits, unless settings.MANIFEST_UPLOAD_ASYNC is off."""
+    cache = api.staging.get_staging_cache()
+    filename = cache.reserve(key)
+    log.debug(f'Writing manifest to staging dir {filename}')
+    write_remote_file_manifest(filename, remote_file_manifest)
+    cache.pin(key)
+    cache.add(key)
+    if settings.MANIFEST_UPLOAD_ASYNC:
+        transaction.on_commit(lambda: schedule_upload(key))
+    else:
+        upload_manifest(key)
+
+
+def schedule_upload(key):
+    """Upload a staged manifest to S3 from the background upload pool."""
+    return _get_upload_executor().submit(_run_upload, key)
+
+
+def upload_manifest(key):
+    """Upload a staged manifest to S3, retrying with exponential backoff up
+    to settings.MANIFEST_UPLOAD_RETRIES times. Progress is recorded in
+    Manifest.upload_state. Returns True if the upload succeeded."""
+    manifests = api.models.Manifest.objects.filter(id=key)
+    cache = api.staging.get_staging_cache()
+    for attempt in range(settings.MANIFEST_UPLOAD_RETRIES + 1):
+        if attempt:
+            time.sleep(settings.MANIFEST_UPLOAD_BACKOFF * 2 ** (attempt - 1))
+        manifests.update(upload_state=api.models.Manifest.UPLOAD_ACTIVE,
+                         upload_attempts=models.F('upload_attempts') + 1)
+        try:
+            api.s3.upload(cache.path(key))
+        except Exception as e:
+            log.warning(f'Upload attempt {attempt + 1} failed for manifest {key}: {e}')
+            continue
+        manifests.update(upload_state=api.models.Manifest.UPLOAD_SUCCEEDED)
+        cache.unpin(key)
+        log.debug(f'Uploaded manifest {key}')
+        return True
+    log.error(f'Giving up uploading manifest {key}, it remains staged locally')
+    manifests.update(upload_state=api.models.Manifest.UPLOAD_FAILED)
+    return False
+
+
+def _run_upload(key):
+    try:
+        return upload_manifest(key)
+    except Exception as e:
+        log.exception(e)
+    finally:
+        # Background threads get their own db connection, don't leak it
+        db.connection.close()
+
+
+def _get_upload_executor():
+    global _upload_executor, _upload_executor_pid
+    with _upload_executor_lock:
+        if _upload_executor is None or _upload_executor_pid != os.getpid():
+            _upload_executor = ThreadPoolExecutor(
+                max_workers=settings.MANIFEST_UPLOAD_WORKERS,
+                thread_name_prefix='manifest-upload')
+            _upload_executor_pid = os.getpid()
+        return _upload_executor
@@ -0,0 +1,25 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_concierge_service_v2'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='manifest',
+            name='upload_attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='manifest',
+            name='upload_state',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('ACTIVE', 'Active'),
+                                            ('SUCCEEDED', 'Succeeded'), ('FAILED', 'Failed')],
+                                   default='SUCCEEDED', max_length=16),
+        ),
+    ]
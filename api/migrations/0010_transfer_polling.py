@@ -0,0 +1,23 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_manifest_upload_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transfer',
+            name='last_polled',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='transfer',
+            name='next_poll',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_transfer_polling'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='manifesttransfer',
+            name='submission_errors',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_created'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conciergetoken',
+            name='dependent_tokens_expire_at',
+            field=models.FloatField(db_index=True, null=True),
+        ),
+    ]
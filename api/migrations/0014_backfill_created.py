@@ -0,0 +1,33 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:00
+
+import datetime
+
+from django.db import migrations
+from django.db.models import Count
+
+
+def backfill_created(apps, schema_editor):
+    """Rows which existed before 0012 all got the same 'created' time.
+    Spread them out a microsecond apart, so cursor pagination on 'created'
+    doesn't have to fall back to offsets within one huge group of ties."""
+    for model_name in ('Manifest', 'ManifestTransfer'):
+        model = apps.get_model('api', model_name)
+        duplicated = (model.objects.order_by().values('created')
+                      .annotate(count=Count('id')).filter(count__gt=1)
+                      .values_list('created', flat=True))
+        for created in list(duplicated):
+            rows = list(model.objects.filter(created=created).order_by('id').only('id', 'created'))
+            for index, row in enumerate(rows):
+                row.created = created - datetime.timedelta(microseconds=len(rows) - 1 - index)
+            model.objects.bulk_update(rows, ['created'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_concierge_token_dependent_tokens_expire_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_created, migrations.RunPython.noop),
+    ]
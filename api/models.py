@@ -4,8 +4,11 @@ import time
 import uuid
 import datetime
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 from django.conf import settings
+import globus_sdk
+import api.cache
 import api.manifest
 import api.transfer
 
@@ -28,6 +31,8 @@ class ConciergeToken(models.Model):
     expires_at = models.FloatField()
     last_introspection = models.FloatField()
     dependent_tokens_cache = models.TextField(blank=True)
+    # Earliest expiry of any dependent token, see refresh_dependent_tokens
+    dependent_tokens_expire_at = models.FloatField(null=True, db_index=True)
 
     @property
     def introspection_cache_expired(self):
@@ -44,20 +49,79 @@ class ConciergeToken(models.Model):
         log.debug(f'Token expires in {self.expires_at - time.time()} secs')
         return time.time() > self.expires_at
 
-    def get_cached_dependent_tokens(self):
+    def get_cached_dependent_tokens(self, save=True):
+        """Return dependent tokens by scope, fetching them if they haven't
+        been yet or have expired. Tokens which expire within
+        settings.GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN are refreshed in the
+        background (see also api.poller), so requests rarely wait on this."""
         if self.dependent_tokens_cache:
-            return json.loads(self.dependent_tokens_cache)
-        else:
-            ac = api.auth.get_auth_client()
-            response = ac.oauth2_get_dependent_tokens(self.id).data
-            by_scope = {toks['scope']: toks for toks in response}
-            self.dependent_tokens_cache = json.dumps(by_scope)
-            self.save()
-            return by_scope
+            expires_in = (self.dependent_tokens_expire_at or float('inf')) - time.time()
+            if expires_in > 0:
+                if self.dependent_tokens_expiring:
+                    api.auth.schedule_dependent_token_refresh(self.id)
+                return json.loads(self.dependent_tokens_cache)
+            log.debug(f'Dependent tokens expired for {self.user}, refreshing')
+        return self.refresh_dependent_tokens(save=save)
+
+    @property
+    def dependent_tokens_expiring(self):
+        """True if cached dependent tokens are still valid, but expire within
+        settings.GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN"""
+        if not self.dependent_tokens_cache or self.dependent_tokens_expire_at is None:
+            return False
+        expires_in = self.dependent_tokens_expire_at - time.time()
+        return 0 < expires_in < settings.GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN
+
+    def refresh_dependent_tokens(self, save=True):
+        """Fetch new dependent tokens, using refresh tokens if there are
+        any. Each token is stored with its 'expires_at' time."""
+        ac = api.auth.get_auth_client()
+        old = json.loads(self.dependent_tokens_cache or '{}')
+        refresh_tokens = {t['refresh_token'] for t in old.values() if t.get('refresh_token')}
+        tokens = []
+        try:
+            for refresh_token in refresh_tokens:
+                response = ac.oauth2_refresh_token(refresh_token).data
+                tokens += [response] + response.get('other_tokens', [])
+        except globus_sdk.exc.GlobusAPIError as gapie:
+            log.warning(f'Unable to refresh dependent tokens for {self.user}: {gapie}')
+            tokens = []
+        if not tokens:
+            params = {'access_type': 'offline'} if settings.GLOBUS_DEPENDENT_TOKENS_OFFLINE else None
+            tokens = ac.oauth2_get_dependent_tokens(self.id, additional_params=params).data
+        now = time.time()
+        by_scope = {}
+        for token in tokens:
+            token = {k: v for k, v in token.items() if k != 'other_tokens'}
+            if token.get('expires_in'):
+                token['expires_at'] = now + token['expires_in']
+            by_scope[token['scope']] = token
+        # Tokens without an expiry are refetched eventually, so the poller
+        # doesn't pick them up on every run
+        expiry = [t['expires_at'] for t in by_scope.values() if 'expires_at' in t]
+        self.dependent_tokens_cache = json.dumps(by_scope)
+        self.dependent_tokens_expire_at = min(expiry or [now + settings.GLOBUS_DEPENDENT_TOKEN_DEFAULT_LIFETIME])
+        if save:
+            self.save(update_fields=['dependent_tokens_cache', 'dependent_tokens_expire_at'])
+        # Refresh tokens don't expire, so revoke any which were replaced
+        kept = {t['refresh_token'] for t in by_scope.values() if t.get('refresh_token')}
+        self.revoke_dependent_tokens(refresh_tokens - kept)
+        return by_scope
 
-    def reset_introspection_cache(self):
+    def revoke_dependent_tokens(self, tokens):
+        """Revoke the given dependent access or refresh tokens. Failures are
+        logged, they shouldn't stop the caller."""
+        ac = api.auth.get_auth_client()
+        for token in tokens:
+            try:
+                ac.oauth2_revoke_token(token)
+            except globus_sdk.exc.GlobusError as ge:
+                log.warning(f'Unable to revoke a dependent token for {self.user}: {ge}')
+
+    def reset_introspection_cache(self, save=True):
         self.last_introspection = time.time()
-        self.save()
+        if save:
+            self.save()
 
     def get_token(self, service):
         if service not in self.SCOPE_PERMISSIONS[self.scope]:
@@ -68,8 +132,13 @@ class ConciergeToken(models.Model):
 
     def revoke_token(self):
         ac = api.auth.get_auth_client()
+        dependent_tokens = json.loads(self.dependent_tokens_cache or '{}').values()
+        self.revoke_dependent_tokens([t[name] for t in dependent_tokens
+                                      for name in ('refresh_token', 'access_token') if t.get(name)])
         ac.oauth2_revoke_token(self.id)
         log.debug(f'Revoking token for user {self.user} scope {self.scope}')
+        api.transfer.evict_transfer_clients(self.id)
+        api.cache.get_token_cache().delete(self.id)
         self.delete()
 
     @classmethod
@@ -81,9 +150,26 @@ class ConciergeToken(models.Model):
 
 
 class Manifest(models.Model):
+    # Manifests are written locally first, then uploaded to S3 in the
+    # background. See api.manifest.upload_remote_file_manifest.
+    UPLOAD_PENDING = 'PENDING'
+    UPLOAD_ACTIVE = 'ACTIVE'
+    UPLOAD_SUCCEEDED = 'SUCCEEDED'
+    UPLOAD_FAILED = 'FAILED'
+    UPLOAD_STATES = (
+        (UPLOAD_PENDING, 'Pending'),
+        (UPLOAD_ACTIVE, 'Active'),
+        (UPLOAD_SUCCEEDED, 'Succeeded'),
+        (UPLOAD_FAILED, 'Failed'),
+    )
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, related_name='bags',
                              on_delete=models.CASCADE)
+    upload_state = models.CharField(max_length=16, choices=UPLOAD_STATES,
+                                    default=UPLOAD_SUCCEEDED)
+    upload_attempts = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
 
     @property
     def manifest_items(self):
@@ -134,6 +220,9 @@ class Manifest(models.Model):
 
 
 class Transfer(models.Model):
+    # Transfers in these states are no longer polled for updates
+    TERMINAL_STATES = ('FAILED', 'PAUSED', 'SUCCEEDED')
+
     task_id = models.UUIDField(primary_key=True)
     user = models.ForeignKey(User, related_name='transfers', on_delete=models.CASCADE)
     submission_id = models.UUIDField()
@@ -147,17 +236,38 @@ class Transfer(models.Model):
     directories = models.IntegerField(default=0)
     effective_bytes_per_second = models.IntegerField(default=0)
     bytes_transferred = models.IntegerField(default=0)
+    # Set by the transfer poller, see api.poller
+    last_polled = models.DateTimeField(null=True)
+    next_poll = models.DateTimeField(null=True, db_index=True)
 
     status = models.CharField(max_length=32)
 
     def update(self):
-        if self.status in ['FAILED', 'PAUSED', 'SUCCEEDED']:
-            log.debug(f'Task {self.task_id} {self.status}, skipping...')
+        self.update_many(ConciergeToken.from_user(self.user), [self])
+
+    @classmethod
+    def update_many(cls, ctoken, transfers):
+        """Update many transfers owned by the user of ctoken, with a bulk
+        status request for all of them."""
+        transfers = [t for t in transfers if t.status not in cls.TERMINAL_STATES]
+        if not transfers:
             return
-        log.debug(f'Updating task {self.task_id}')
-        task = api.transfer.get_task(ConciergeToken.from_user(self.user), str(self.task_id))
-        # from pprint import pprint
-        # pprint(task.data)
+        log.debug(f'Updating tasks {[str(t.task_id) for t in transfers]}')
+        tasks = api.transfer.get_tasks(ctoken, [t.task_id for t in transfers])
+        for transfer, task in zip(transfers, tasks):
+            transfer.update_from_task(task)
+
+    @property
+    def is_stale(self):
+        """True if the poller has fallen behind on this transfer"""
+        if self.status in self.TERMINAL_STATES:
+            return False
+        stale_after = datetime.timedelta(seconds=settings.TRANSFER_POLL_STALE_AFTER)
+        due = self.next_poll or self.start_time
+        return due + stale_after < timezone.now()
+
+    def update_from_task(self, task):
+        """Update and save this transfer from a Globus Transfer task document"""
         self.status = task['status']
         self.source_endpoint_id = task['source_endpoint_id']
         self.source_endpoint_display_name = task['source_endpoint_display_name'] or task['source_endpoint']
@@ -171,8 +281,21 @@ class Transfer(models.Model):
         self.effective_bytes_per_second = task['effective_bytes_per_second']
         if task['completion_time']:
             self.completion_time = datetime.datetime.fromisoformat(task['completion_time'])
+        self.schedule_next_poll()
         self.save()
 
+    def schedule_next_poll(self, now=None):
+        """Young transfers are polled often, and older ones less so. The poll
+        interval is a fraction of the transfer's age, between
+        settings.TRANSFER_POLL_MIN_INTERVAL and TRANSFER_POLL_MAX_INTERVAL."""
+        now = now or timezone.now()
+        self.last_polled = now
+        age = (now - self.start_time).total_seconds() if self.start_time else 0
+        interval = min(max(age * settings.TRANSFER_POLL_AGE_FACTOR,
+                           settings.TRANSFER_POLL_MIN_INTERVAL),
+                       settings.TRANSFER_POLL_MAX_INTERVAL)
+        self.next_poll = now + datetime.timedelta(seconds=interval)
+
 
 class ManifestTransfer(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -182,14 +305,26 @@ class ManifestTransfer(models.Model):
     transfers = models.ManyToManyField(Transfer)
     action = models.ForeignKey('gap.Action', models.SET_NULL,
                                blank=True, null=True,)
+    # JSON list of endpoints which failed to submit, see
+    # api.transfer.get_submission_error
+    submission_errors = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def get_submission_errors(self):
+        return json.loads(self.submission_errors or '[]')
 
     @property
     def status(self):
-        # THIS IS TERRIBLE, IT SHOULD BE MOVED TO AN ASYNC ROUTINE, NOT PIGGYBACKED ON USER REQUESTS
-        for transfer in self.transfers.all():
-            transfer.update()
-
+        """Overall status of all transfers. Transfer statuses are kept up to
+        date by the transfer poller (api.poller), and read from the db. The
+        manifest can't be fully transferred if any part of it failed to
+        submit, so that counts as FAILED, but only once the transfers which
+        were submitted have stopped. Until then they can still be cancelled."""
         statuses = [t.status for t in self.transfers.all()]
+        if self.submission_errors:
+            if any(s not in Transfer.TERMINAL_STATES for s in statuses):
+                return 'ACTIVE'
+            return 'FAILED'
         if all([s == 'SUCCEEDED' for s in statuses]):
             return 'SUCCEEDED'
         if any([s == 'FAILED' for s in statuses]):
@@ -0,0 +1,100 @@
+"""
+Background poller for Globus Transfer task status.
+
+API requests read transfer status straight from the db. This poller is
+what keeps it current: it refreshes every Transfer which hasn't reached a
+terminal state once its next_poll time comes up. See
+Transfer.schedule_next_poll for how often each transfer is polled. It also
+refreshes dependent tokens before they expire.
+
+Run it with: python manage.py poll_transfers
+"""
+import logging
+import time
+from itertools import groupby
+
+from django import db
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+import api.auth
+from api.models import ConciergeToken, Transfer
+
+log = logging.getLogger(__name__)
+
+
+def get_due_transfers(now=None):
+    now = now or timezone.now()
+    return (Transfer.objects
+            .exclude(status__in=Transfer.TERMINAL_STATES)
+            .filter(Q(next_poll__isnull=True) | Q(next_poll__lte=now))
+            .select_related('user')
+            .order_by('user', 'next_poll'))
+
+
+def poll_transfers(now=None):
+    """Refresh all transfers which are due to be polled. Returns the number
+    of transfers which were updated."""
+    now = now or timezone.now()
+    updated = 0
+    for user, transfers in groupby(get_due_transfers(now), key=lambda t: t.user):
+        transfers = list(transfers)
+        ctoken = ConciergeToken.from_user(user)
+        if ctoken is None:
+            log.warning(f'No active token for {user}, unable to poll {len(transfers)} transfers')
+            for transfer in transfers:
+                transfer.schedule_next_poll(now)
+                transfer.save(update_fields=['last_polled', 'next_poll'])
+            continue
+        try:
+            Transfer.update_many(ctoken, transfers)
+            updated += len(transfers)
+        except Exception as e:
+            log.exception(e)
+            for transfer in transfers:
+                transfer.schedule_next_poll(now)
+                transfer.save(update_fields=['last_polled', 'next_poll'])
+    return updated
+
+
+def refresh_dependent_tokens(now=None):
+    """Refresh dependent tokens which expire within
+    settings.GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN, for tokens which are
+    still valid. Returns the number of tokens refreshed."""
+    now = now or time.time()
+    due = (ConciergeToken.objects
+           .filter(expires_at__gt=now)
+           .exclude(dependent_tokens_cache='')
+           .filter(Q(dependent_tokens_expire_at__isnull=True) |
+                   Q(dependent_tokens_expire_at__lt=now + settings.GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN))
+           .values_list('id', flat=True))
+    refreshed = 0
+    for token_id in due:
+        try:
+            api.auth.refresh_dependent_tokens(token_id)
+            refreshed += 1
+        except Exception as e:
+            log.exception(e)
+    return refreshed
+
+
+def run(interval=None, once=False):
+    """Poll transfers every ``interval`` seconds, forever unless ``once``"""
+    interval = interval or settings.TRANSFER_POLL_TICK
+    while True:
+        started = time.time()
+        try:
+            updated = poll_transfers()
+            if updated:
+                log.debug(f'Updated {updated} transfers')
+            refreshed = refresh_dependent_tokens()
+            if refreshed:
+                log.debug(f'Refreshed dependent tokens for {refreshed} tokens')
+        except db.Error as e:
+            # Drop the connection, the next run will reconnect
+            log.exception(e)
+            db.connection.close()
+        if once:
+            return
+        time.sleep(max(interval - (time.time() - started), 0))
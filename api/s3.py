@@ -1,13 +1,19 @@
 import os
 import logging
+import tempfile
+import threading
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from django.conf import settings
 
-log = logging.getLogger(__name__)
+from api.staging import get_staging_cache
 
+log = logging.getLogger(__name__)
 
-def get_local_file(resource):
-    return os.path.join(settings.AWS_STAGING_DIR, resource)
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
 
 
 def get_s3_object(resource):
@@ -15,20 +21,70 @@ def get_s3_object(resource):
     return os.path.join(folder, resource)
 
 
-def get_s3_bucket():
-    s3 = boto3.resource('s3', aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
-                        aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
-    return s3.Bucket(settings.AWS_BUCKET_NAME)
+def get_s3_client():
+    """Return the S3 client for this process. boto3 clients are thread safe,
+    so one client and its connection pool are shared by all threads. Clients
+    must not be shared across a fork (gunicorn forks its workers after
+    loading the app), so a new client is built if the process id changes."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                log.debug(f'Creating S3 client for process {pid}')
+                session = boto3.session.Session(
+                    aws_access_key_id=settings.AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY)
+                config = Config(max_pool_connections=settings.AWS_S3_MAX_POOL_CONNECTIONS)
+                _client = session.client('s3', config=config)
+                _client_pid = pid
+    return _client
+
+
+def get_transfer_config():
+    return TransferConfig(
+        multipart_threshold=settings.AWS_S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=settings.AWS_S3_MULTIPART_CHUNKSIZE,
+        max_concurrency=settings.AWS_S3_MAX_CONCURRENCY,
+    )
+
+
+def _reset_client():
+    global _client, _client_pid, _client_lock
+    _client, _client_pid = None, None
+    _client_lock = threading.Lock()
+
+
+# The lock may be held by another thread at the time of a fork, so give the
+# child a fresh one (along with a fresh client).
+os.register_at_fork(after_in_child=_reset_client)
 
 
 def upload(filename):
     resource = get_s3_object(os.path.basename(filename))
     log.debug(f'Uploading local {filename} to resource {resource}')
-    get_s3_bucket().upload_file(filename, resource, ExtraArgs={'ACL': 'bucket-owner-full-control'})
+    get_s3_client().upload_file(filename, settings.AWS_BUCKET_NAME, resource,
+                                ExtraArgs={'ACL': 'bucket-owner-full-control'},
+                                Config=get_transfer_config())
 
 
 def download(resource):
-    local_file = get_local_file(resource)
+    cache = get_staging_cache()
+    local_file = cache.reserve(resource)
     log.debug(f'Downloading {local_file}')
-    get_s3_bucket().download_file(get_s3_object(resource), local_file)
+    # Download under a unique temporary name, so partial files are never
+    # read and are left alone by cache eviction
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(local_file),
+                                    prefix=f'{os.path.basename(local_file)}.', suffix='.tmp')
+    os.close(fd)
+    try:
+        get_s3_client().download_file(settings.AWS_BUCKET_NAME, get_s3_object(resource), tmp_file,
+                                      Config=get_transfer_config())
+        os.replace(tmp_file, local_file)
+    finally:
+        try:
+            os.remove(tmp_file)
+        except FileNotFoundError:
+            pass
+    cache.add(resource)
     return local_file
@@ -3,6 +3,7 @@ Serializers for the Globus Manifest Spec
 
 More info here https://globusonline.github.io/manifests/overview.html
 """
+import json
 import logging
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
@@ -12,6 +13,7 @@ import api.models
 import api.serializers.transfer
 import api.transfer
 import api.manifest
+from api.serializers.validation import FastListSerializer
 
 log = logging.getLogger(__name__)
 
@@ -36,6 +38,9 @@ class RemoteFileManifestEntrySerializer(serializers.Serializer):
     md5 = serializers.CharField(max_length=32, required=False, help_text='MD5 checksum of the file')
     sha256 = serializers.CharField(max_length=64, required=False, help_text='SHA256 checksum of the file')
 
+    class Meta:
+        list_serializer_class = FastListSerializer
+
     def validate(self, data):
         if not any(data.get(f) for f in self.SUPPORTED_CHECKSUMS):
             raise ValidationError(f'Required one of '
@@ -49,12 +54,15 @@ class RemoteFileManifestSerializer(serializers.ModelSerializer):
                                                                                   'Entries')
 
     class Meta:
-        fields = '__all__'
+        # Upload state and timestamps are internal, and must not change the
+        # (cacheable) representation of a manifest
+        fields = ('id', 'user', 'remote_file_manifest')
         read_only_fields = ['user']
         model = api.models.Manifest
 
     def create(self, validated_data):
-        model = api.models.Manifest.objects.create(user=self.context['request'].user)
+        model = api.models.Manifest.objects.create(user=self.context['request'].user,
+                                                   upload_state=api.models.Manifest.UPLOAD_PENDING)
         api.manifest.upload_remote_file_manifest(model.id, validated_data['remote_file_manifest'])
         # Since validated_data already contains the RFM, pass it here to avoid a second fetch.
         validated_data.update(dict(user=model.user, id=model.id))
@@ -72,6 +80,9 @@ class GlobusManifestItemSerializer(serializers.Serializer):
     dest_path = serializers.CharField(help_text='Filename or dir path to name the "source_ref" resource on transfer')
     checksum = GlobusManifestChecksumSerializer(required=False)
 
+    class Meta:
+        list_serializer_class = FastListSerializer
+
 
 class GlobusManifestSerializer(serializers.ModelSerializer):
 
@@ -85,11 +96,10 @@ class GlobusManifestSerializer(serializers.ModelSerializer):
         read_only_fields = ['manifest_id', 'user']
 
     def create(self, validated_data):
-        rfm = api.manifest.gm_to_rfm(validated_data['manifest_items'])
-        model = api.models.Manifest.objects.create(user=self.context['request'].user)
-        location = api.manifest.upload_remote_file_manifest(model.id, rfm)
-        model.location = location
-        model.save()
+        model = api.models.Manifest.objects.create(user=self.context['request'].user,
+                                                   upload_state=api.models.Manifest.UPLOAD_PENDING)
+        rfm = api.manifest.iter_gm_to_rfm(validated_data['manifest_items'])
+        api.manifest.upload_remote_file_manifest(model.id, rfm)
         # Since validated_data already contains the RFM,
         validated_data.update(dict(user=model.user, id=model.id))
         return validated_data
@@ -105,11 +115,12 @@ class GlobusManifestSerializer(serializers.ModelSerializer):
 
 
 class ManifestTransferSerializer(serializers.ModelSerializer):
-    manifest_id = serializers.ReadOnlyField(source='manifest.id')
+    manifest_id = serializers.ReadOnlyField()
     manifest_transfer_id = serializers.ReadOnlyField(source='id')
 
     user = serializers.ReadOnlyField(source='user.username')
     status = serializers.ReadOnlyField()
+    submission_errors = serializers.ReadOnlyField(source='get_submission_errors')
     destination = api.serializers.transfer.GlobusURL(
         help_text='Globus endpoint and path destination to transfer manifest files',
         write_only=True,
@@ -131,19 +142,14 @@ class ManifestTransferSerializer(serializers.ModelSerializer):
             manifest_id = self.context['view'].kwargs.get('manifest_id')
         log.debug(f'Creating transfer with manifest_id {manifest_id}')
         manifest = api.models.Manifest.objects.get(id=manifest_id)
-        try:
-            rfm = RemoteFileManifestSerializer(manifest)
-            gm_data = api.manifest.rfm_to_gm(rfm.to_internal_value(rfm.data))
-            log.debug('Created ManifestTransfer via Remote File Manifest')
-        except Exception:
-            gm = GlobusManifestSerializer(manifest)
-            gm_data = gm.to_internal_value(gm.data)
-            log.debug('Created ManifestTransfer via Globus Manifest')
+        gm_data = {'manifest_items': api.manifest.iter_transfer_items(manifest.id)}
         auth = self.context['request'].auth
         dest = validated_data['destination']
-        transfers = api.transfer.transfer_manifest(auth, gm_data, dest)
+        result = api.transfer.transfer_manifest(auth, gm_data, dest)
+        transfers = result['transfers']
         manifest_transfer = api.models.ManifestTransfer.objects.create(
-            user=auth.user, manifest=manifest, destination=dest
+            user=auth.user, manifest=manifest, destination=dest,
+            submission_errors=json.dumps(result['errors']) if result['errors'] else '',
         )
         for transfer in transfers:
             transfer_m = api.models.Transfer.objects.create(**dict(
@@ -0,0 +1,178 @@
+"""
+Local disk cache for manifests stored in S3.
+
+Manifests are kept under settings.AWS_STAGING_DIR in a sharded layout, so
+no single directory grows too large:
+
+    <AWS_STAGING_DIR>/<key[0:2]>/<key[2:4]>/<key>
+
+The cache is bounded by settings.AWS_STAGING_MAX_BYTES. When it grows past
+the limit, the least recently used files are removed until it is back under
+settings.AWS_STAGING_LOW_WATER of the limit. Files are touched on every
+cache hit, so their modification time doubles as their last access time
+regardless of how the filesystem is mounted.
+
+Files can be pinned while they are the only copy of a manifest (for
+example before the manifest has been uploaded to S3). Pinned files have a
+'<key>.pending' marker next to them, and are never evicted.
+"""
+import os
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+log = logging.getLogger(__name__)
+
+# Number of directory levels and characters per level in the sharded layout
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+PIN_SUFFIX = '.pending'
+# Temporary files older than this were left behind by an interrupted
+# download, and are evicted along with everything else
+STALE_TMP_AGE = 60 * 60 * 24
+
+
+class StagingCache(object):
+
+    def __init__(self, root, max_bytes, low_water=0.9):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.hits = self.misses = self.evictions = self.evicted_bytes = 0
+        # Estimated bytes on disk, updated as files are added. Other
+        # processes share the directory, so this is re-synced from disk
+        # each time the cache is scanned.
+        self._size = None
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'evicted_bytes': self.evicted_bytes,
+                'size': self._size}
+
+    def path(self, key):
+        key = str(key)
+        shards = [key[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH]
+                  for i in range(SHARD_DEPTH)]
+        return os.path.join(self.root, *shards, key)
+
+    def lookup(self, key):
+        """Return the local path for key if it is cached, otherwise None."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            legacy_path = os.path.join(self.root, str(key))
+            if not os.path.isfile(legacy_path):
+                self.misses += 1
+                return None
+            # Move files from the old flat layout into their shard
+            log.debug(f'Moving {legacy_path} to {path}')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                os.replace(legacy_path, path)
+            except FileNotFoundError:
+                # Another process moved it first
+                if not os.path.exists(path):
+                    self.misses += 1
+                    return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted by another process in the meantime
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def reserve(self, key):
+        """Return the path where key should be written, creating its shard
+        directories if needed. Call add() once the file is written."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def pin(self, key):
+        """Protect key from eviction until unpin() is called."""
+        open(self.path(key) + PIN_SUFFIX, 'w').close()
+
+    def unpin(self, key):
+        try:
+            os.remove(self.path(key) + PIN_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    def is_pinned(self, key):
+        return os.path.exists(self.path(key) + PIN_SUFFIX)
+
+    def add(self, key):
+        """Account for a newly written file, evicting old files if the cache
+        is now over its limit."""
+        size = os.path.getsize(self.path(key))
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            else:
+                self._size += size
+            over_limit = self._size > self.max_bytes
+        if over_limit:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used files until the cache is under the low
+        water mark."""
+        with self._lock:
+            files, total = self._scan()
+            target = self.max_bytes * self.low_water
+            for mtime, size, path in sorted(files):
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.evictions += 1
+                self.evicted_bytes += size
+            self._size = total
+        log.info(f'Staging cache {self.root} stats: {self.stats}')
+
+    def _scan(self):
+        """Return all evictable files as (mtime, size, path), and the total
+        size of the cache. Pinned files count towards the total but are not
+        returned. Files still being written (*.tmp*) are skipped, unless
+        they are older than STALE_TMP_AGE."""
+        files, total = [], 0
+        stale_before = time.time() - STALE_TMP_AGE
+        for dirpath, _, filenames in os.walk(self.root):
+            pinned = {name[:-len(PIN_SUFFIX)] for name in filenames
+                      if name.endswith(PIN_SUFFIX)}
+            for name in filenames:
+                if name.endswith(PIN_SUFFIX):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if '.tmp' in name and st.st_mtime > stale_before:
+                    continue
+                total += st.st_size
+                if name not in pinned:
+                    files.append((max(st.st_mtime, st.st_atime), st.st_size, path))
+        return files, total
+
+
+_staging_caches = {}
+_staging_caches_lock = threading.Lock()
+
+
+def get_staging_cache():
+    """Return the StagingCache for the currently configured staging dir."""
+    key = (settings.AWS_STAGING_DIR, settings.AWS_STAGING_MAX_BYTES)
+    with _staging_caches_lock:
+        if key not in _staging_caches:
+            _staging_caches[key] = StagingCache(*key, low_water=settings.AWS_STAGING_LOW_WATER)
+        return _staging_caches[key]
@@ -0,0 +1,95 @@
+"""
+Streaming JSON responses for large serialized lists.
+
+Manifests can hold millions of entries. Rather than building the whole
+serializer output and rendering it in one piece, the list field is rendered
+entry by entry as entries are read from storage, so each response uses a
+constant amount of memory. The output is byte for byte what JSONRenderer
+would produce for the same serializer.
+"""
+import logging
+import zlib
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from rest_framework.renderers import JSONRenderer
+
+log = logging.getLogger(__name__)
+
+
+def can_stream(request):
+    """Only plain JSON responses are streamed. The browsable API and
+    indented JSON are rendered normally."""
+    renderer = request.accepted_renderer
+    return type(renderer) is JSONRenderer and \
+        renderer.get_indent(request.accepted_media_type, {}) is None
+
+
+def streaming_json_response(request, serializer, field_name, entries):
+    """Return a StreamingHttpResponse for ``serializer.data``, where the list
+    field ``field_name`` is rendered from ``entries`` instead of being read
+    from the instance. The response is gzipped if the client accepts it and
+    settings.MANIFEST_STREAM_GZIP is on."""
+    chunks = iter_json(serializer, field_name, entries)
+    response = StreamingHttpResponse(content_type=JSONRenderer.media_type)
+    if settings.MANIFEST_STREAM_GZIP:
+        patch_vary_headers(response, ('Accept-Encoding',))
+    if get_content_encoding(request) == 'gzip':
+        chunks = gzip_chunks(chunks)
+        response['Content-Encoding'] = 'gzip'
+    response.streaming_content = chunks
+    return response
+
+
+def get_content_encoding(request):
+    """Return the content encoding a streamed response will use"""
+    if settings.MANIFEST_STREAM_GZIP and 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        return 'gzip'
+    return 'identity'
+
+
+def iter_json(serializer, field_name, entries):
+    """Yield the rendered JSON for a serializer in chunks of up to
+    settings.MANIFEST_STREAM_CHUNK_SIZE list entries."""
+    renderer = JSONRenderer()
+    field_names = [f.field_name for f in serializer._readable_fields]
+    index = field_names.index(field_name)
+    child = serializer.fields.pop(field_name).child
+    # Render everything but the list field, then stream the list in between
+    data = serializer.data
+    before = {k: v for k, v in data.items() if k in field_names[:index]}
+    after = {k: v for k, v in data.items() if k in field_names[index + 1:]}
+    yield render_fields(renderer, before, first=True) + render_key(renderer, field_name, bool(before)) + b'['
+
+    chunk, count, size = [], 0, settings.MANIFEST_STREAM_CHUNK_SIZE
+    for entry in entries:
+        chunk.append(renderer.render(child.to_representation(entry)))
+        if len(chunk) >= size:
+            yield (b',' if count else b'') + b','.join(chunk)
+            count += len(chunk)
+            chunk = []
+    if chunk:
+        yield (b',' if count else b'') + b','.join(chunk)
+    yield b']' + render_fields(renderer, after, first=False) + b'}'
+
+
+def render_key(renderer, key, comma):
+    return (b',' if comma else b'') + renderer.render(key) + b':'
+
+
+def render_fields(renderer, data, first):
+    """Render the members of a JSON object, without the closing brace"""
+    rendered = renderer.render(data)[1:-1]
+    if first:
+        return b'{' + rendered
+    return (b',' + rendered) if rendered else b''
+
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(settings.MANIFEST_COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,48 @@
+import uuid
+
+import pytest
+
+from api.serializers.manifest import GlobusManifestSerializer, RemoteFileManifestSerializer
+
+ep = str(uuid.uuid4())
+
+
+def rfm_entry(i, **kwargs):
+    entry = {'url': f'globus://{ep}/foo{i}.txt', 'filename': f'foo{i}.txt',
+             'length': i, 'md5': 'a' * 32}
+    entry.update(kwargs)
+    return entry
+
+
+def validate(serializer_class, data, settings, threshold):
+    settings.MANIFEST_FAST_VALIDATION_THRESHOLD = threshold
+    serializer = serializer_class(data=data)
+    serializer.is_valid()
+    return serializer.errors, serializer.validated_data if not serializer.errors else None
+
+
+@pytest.mark.parametrize('entries', [
+    [rfm_entry(i) for i in range(5)],
+    [rfm_entry(0, length='12', filename=' bar.txt', sha256='b' * 64), rfm_entry(1, filename='naïve.txt')],
+    [rfm_entry(0), rfm_entry(1, md5=None), rfm_entry(2, url='ftp://example.com/foo'),
+     rfm_entry(3, filename='f' * 257), rfm_entry(4, length='foo'), {'url': f'globus://{ep}/foo'}],
+    [rfm_entry(0), rfm_entry(1, md5=''), 'not a dict'],
+])
+def test_fast_validation_matches_drf_rfm(entries, settings):
+    data = {'remote_file_manifest': entries}
+    assert validate(RemoteFileManifestSerializer, data, settings, 1) == \
+        validate(RemoteFileManifestSerializer, data, settings, 1000)
+
+
+@pytest.mark.parametrize('items', [
+    [{'source_ref': f'globus://{ep}/foo.txt', 'dest_path': 'foo.txt',
+      'checksum': {'algorithm': 'md5', 'value': 'a' * 32}},
+     {'source_ref': f'globus://{ep}/dir/', 'dest_path': 'dir'}],
+    [{'source_ref': f'globus://{ep}/foo.txt', 'dest_path': 'foo.txt', 'checksum': None},
+     {'source_ref': f'globus://{ep}/foo.txt', 'dest_path': 'foo.txt', 'checksum': {'algorithm': 'md5'}},
+     {'source_ref': 'globus://not-a-uuid/foo.txt', 'dest_path': 'foo.txt'}],
+])
+def test_fast_validation_matches_drf_gm(items, settings):
+    data = {'manifest_items': items}
+    assert validate(GlobusManifestSerializer, data, settings, 1) == \
+        validate(GlobusManifestSerializer, data, settings, 1000)
@@ -0,0 +1,147 @@
+import json
+import time
+from unittest.mock import Mock
+
+import globus_sdk
+import pytest
+
+import api.auth
+import api.cache
+from api.models import ConciergeToken
+
+
+@pytest.fixture
+def token_cache(monkeypatch):
+    monkeypatch.setattr(api.cache, '_token_cache', None)
+    return api.cache.get_token_cache()
+
+
+@pytest.fixture
+def mock_ac(monkeypatch, settings):
+    ac = Mock()
+    ac.oauth2_token_introspect.return_value.data = {
+        'active': True, 'sub': 'sub', 'username': 'bob@globus.org', 'name': 'Bob Bobson',
+        'email': 'bob@globus.org', 'exp': time.time() + 60, 'iat': time.time(),
+        'scope': settings.CONCIERGE_SCOPE,
+    }
+    ac.oauth2_get_dependent_tokens.return_value.data = [
+        {'scope': settings.TRANSFER_SCOPE, 'access_token': 'tok'}
+    ]
+    monkeypatch.setattr(api.auth, 'get_auth_client', Mock(return_value=ac))
+    return ac
+
+
+@pytest.mark.django_db
+def test_introspection_is_cached(token_cache, mock_ac, django_assert_num_queries):
+    ctoken = api.auth.introspect_globus_token('raw_token')
+    assert json.loads(ConciergeToken.objects.get(pk='raw_token').dependent_tokens_cache)
+    with django_assert_num_queries(0):
+        assert api.auth.introspect_globus_token('raw_token') is ctoken
+    assert mock_ac.oauth2_token_introspect.call_count == 1
+
+
+@pytest.mark.django_db
+def test_introspection_window_expires(token_cache, mock_ac, settings, django_assert_num_queries):
+    settings.GLOBUS_INTROSPECTION_CACHE_EXPIRATION = 0
+    api.auth.introspect_globus_token('raw_token')
+    assert token_cache.get('raw_token') is None
+    # Reading the token and its user, and a single save
+    with django_assert_num_queries(2):
+        api.auth.introspect_globus_token('raw_token')
+    assert mock_ac.oauth2_token_introspect.call_count == 2
+
+
+@pytest.mark.django_db
+def test_dependent_tokens_store_expiry(token_cache, mock_ac, settings):
+    mock_ac.oauth2_get_dependent_tokens.return_value.data = [
+        {'scope': settings.TRANSFER_SCOPE, 'access_token': 'tok', 'expires_in': 3600, 'refresh_token': 'rt'}
+    ]
+    ctoken = api.auth.introspect_globus_token('raw_token')
+    ctoken.refresh_from_db()
+    assert time.time() + 3500 < ctoken.dependent_tokens_expire_at < time.time() + 3600
+    _, kwargs = mock_ac.oauth2_get_dependent_tokens.call_args
+    assert kwargs['additional_params'] == {'access_type': 'offline'}
+
+    mock_ac.oauth2_refresh_token.return_value.data = {
+        'scope': settings.TRANSFER_SCOPE, 'access_token': 'new_tok', 'expires_in': 3600,
+        'refresh_token': 'rt', 'other_tokens': [],
+    }
+    ctoken.refresh_dependent_tokens()
+    mock_ac.oauth2_refresh_token.assert_called_once_with('rt')
+    assert ConciergeToken.objects.get(pk='raw_token').get_token(settings.TRANSFER_SCOPE) == 'new_tok'
+
+
+@pytest.mark.django_db
+def test_expiring_dependent_tokens_refresh_in_background(token_cache, mock_ac, monkeypatch, settings):
+    monkeypatch.setattr(api.auth, 'schedule_dependent_token_refresh', Mock())
+    ctoken = api.auth.introspect_globus_token('raw_token')
+    ctoken.dependent_tokens_expire_at = time.time() + settings.GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN / 2
+    assert ctoken.get_token(settings.TRANSFER_SCOPE) == 'tok'
+    api.auth.schedule_dependent_token_refresh.assert_called_once_with('raw_token')
+
+    ctoken.dependent_tokens_expire_at = time.time() - 1
+    mock_ac.oauth2_get_dependent_tokens.return_value.data = [
+        {'scope': settings.TRANSFER_SCOPE, 'access_token': 'new_tok', 'expires_in': 3600}
+    ]
+    assert ctoken.get_token(settings.TRANSFER_SCOPE) == 'new_tok'
+
+
+@pytest.mark.django_db
+def test_introspection_keeps_background_refresh(token_cache, mock_ac, monkeypatch, settings):
+    settings.GLOBUS_INTROSPECTION_CACHE_EXPIRATION = 0
+    api.auth.introspect_globus_token('raw_token')
+    ConciergeToken.objects.filter(pk='raw_token').update(
+        dependent_tokens_expire_at=time.time() + settings.GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN / 2)
+    new_tokens = json.dumps({settings.TRANSFER_SCOPE: {'access_token': 'new_tok'}})
+
+    def refresh_finishes_first(token_id):
+        ConciergeToken.objects.filter(pk=token_id).update(dependent_tokens_cache=new_tokens,
+                                                          dependent_tokens_expire_at=time.time() + 3600)
+    monkeypatch.setattr(api.auth, 'schedule_dependent_token_refresh', Mock(side_effect=refresh_finishes_first))
+    api.auth.introspect_globus_token('raw_token')
+    api.auth.schedule_dependent_token_refresh.assert_called_once_with('raw_token')
+    assert ConciergeToken.objects.get(pk='raw_token').dependent_tokens_cache == new_tokens
+    assert token_cache.get('raw_token') is None
+
+
+@pytest.mark.django_db
+def test_dependent_tokens_without_expiry(token_cache, mock_ac, settings):
+    ctoken = api.auth.introspect_globus_token('raw_token')
+    lifetime = settings.GLOBUS_DEPENDENT_TOKEN_DEFAULT_LIFETIME
+    assert time.time() + lifetime - 60 < ctoken.dependent_tokens_expire_at <= time.time() + lifetime
+
+
+class ExpiredRefreshToken(globus_sdk.exc.GlobusAPIError):
+    def __init__(self):
+        pass
+
+    def __str__(self):
+        return 'invalid_grant'
+
+
+@pytest.mark.django_db
+def test_dependent_refresh_tokens_are_revoked(token_cache, mock_ac, settings):
+    mock_ac.oauth2_get_dependent_tokens.return_value.data = [
+        {'scope': settings.TRANSFER_SCOPE, 'access_token': 'tok', 'expires_in': 3600, 'refresh_token': 'rt'}
+    ]
+    ctoken = api.auth.introspect_globus_token('raw_token')
+    # The refresh token no longer works, so new dependent tokens replace it
+    mock_ac.oauth2_refresh_token.side_effect = ExpiredRefreshToken()
+    mock_ac.oauth2_get_dependent_tokens.return_value.data = [
+        {'scope': settings.TRANSFER_SCOPE, 'access_token': 'tok2', 'expires_in': 3600, 'refresh_token': 'rt2'}
+    ]
+    ctoken.refresh_dependent_tokens()
+    mock_ac.oauth2_revoke_token.assert_called_once_with('rt')
+
+    mock_ac.oauth2_revoke_token.reset_mock()
+    ctoken.revoke_token()
+    revoked = [c[0][0] for c in mock_ac.oauth2_revoke_token.call_args_list]
+    assert sorted(revoked) == ['raw_token', 'rt2', 'tok2']
+
+
+def test_auth_client_is_shared(settings, monkeypatch):
+    monkeypatch.setattr(api.auth, '_auth_client', None)
+    ac = api.auth.get_auth_client()
+    assert api.auth.get_auth_client() is ac
+    settings.GLOBUS_KEY = 'another_client_id'
+    assert api.auth.get_auth_client() is not ac
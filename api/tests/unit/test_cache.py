@@ -0,0 +1,74 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api.cache import LRUCache, SingleFlight, TokenCache
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.stats['evictions'] == 1
+
+
+def test_lru_cache_sizeof():
+    cache = LRUCache(10, sizeof=len)
+    cache.set('a', 'x' * 6)
+    cache.set('b', 'x' * 6)
+    assert cache.get('a') is None
+    cache.set('c', 'x' * 11)
+    assert cache.get('c') is None
+    assert cache.size == 6
+
+
+def test_lru_cache_ttl():
+    cache = LRUCache(10, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=-1)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+
+
+def test_lru_cache_expired_entries_are_dropped(monkeypatch):
+    cache = LRUCache(10, ttl=1)
+    cache.set('a', 1)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 2)
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_call():
+        calls.append(1)
+        started.set()
+        release.wait()
+        return 'result'
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        leader = pool.submit(flight.do, 'key', slow_call)
+        started.wait()
+        followers = [pool.submit(flight.do, 'key', slow_call) for _ in range(3)]
+        time.sleep(0.05)
+        release.set()
+        assert [f.result() for f in [leader] + followers] == ['result'] * 4
+    assert len(calls) == 1
+    # Nothing is remembered once the call is done
+    assert flight.do('key', lambda: 'again') == 'again'
+
+
+def test_token_cache_lock(settings):
+    settings.CACHES = dict(settings.CACHES, shared={'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'})
+    settings.GLOBUS_INTROSPECTION_LOCK_TIMEOUT = 1
+    cache = TokenCache(10, shared='shared')
+    with cache.lock('raw_token'):
+        assert not cache.shared.add(f"{cache.key('raw_token')}:lock", 1)
+    assert cache.shared.add(f"{cache.key('raw_token')}:lock", 1)
@@ -0,0 +1,121 @@
+import gzip
+import json
+from unittest.mock import Mock
+
+import pytest
+
+from api import manifest
+from api.models import Manifest
+
+RFM = [
+    {'url': 'globus://ddb59aef-6d04-11e5-ba46-22000b92c6ec/share/godata/file1.txt',
+     'length': 4, 'filename': 'file1.txt', 'md5': '5bbf5a52328e7439ae6e719dfe712200'},
+    {'url': 'globus://ddb59aef-6d04-11e5-ba46-22000b92c6ec/share/godata/file2.txt',
+     'length': 5, 'filename': 'file2.txt', 'md5': '5bbf5a52328e7439ae6e719dfe712201'},
+]
+
+
+def test_write_read_remote_file_manifest(tmp_path):
+    filename = str(tmp_path / 'manifest')
+    manifest.write_remote_file_manifest(filename, iter(RFM))
+    with gzip.open(filename, 'rt') as f:
+        header = json.loads(f.readline())
+    assert header['version'] == manifest.MANIFEST_VERSION
+    assert list(manifest.read_remote_file_manifest(filename)) == RFM
+    assert [p.name for p in tmp_path.iterdir()] == ['manifest']
+
+
+def test_read_version_1_remote_file_manifest(tmp_path):
+    filename = tmp_path / 'manifest'
+    filename.write_text(json.dumps({'remote_file_manifest': RFM}))
+    assert list(manifest.read_remote_file_manifest(str(filename))) == RFM
+
+
+def test_read_unknown_manifest_version(tmp_path):
+    filename = str(tmp_path / 'manifest')
+    with gzip.open(filename, 'wt') as f:
+        f.write(json.dumps({'format': manifest.MANIFEST_FORMAT, 'version': 99}))
+    with pytest.raises(ValueError):
+        list(manifest.read_remote_file_manifest(filename))
+
+
+def test_rfm_to_gm_uses_strongest_checksum():
+    rfm = [{'url': 'globus://ep/a.txt', 'filename': 'a.txt', 'length': 1,
+            'md5': 'md5sum', 'sha256': 'sha256sum'},
+           {'url': 'globus://ep/b.txt', 'filename': 'b.txt', 'length': 1}]
+    gm = manifest.iter_rfm_to_gm(iter(rfm))
+    assert next(gm) == {'source_ref': 'globus://ep/a.txt', 'dest_path': 'a.txt',
+                        'checksum': {'algorithm': 'sha256', 'value': 'sha256sum'}}
+    assert next(gm) == {'source_ref': 'globus://ep/b.txt', 'dest_path': 'b.txt'}
+
+
+def test_gm_to_rfm_round_trip():
+    gm = [{'source_ref': 'globus://ep/a.txt', 'dest_path': 'a.txt',
+           'checksum': {'algorithm': 'md5', 'value': 'md5sum'}},
+          {'source_ref': 'globus://ep/dir/', 'dest_path': 'dir'}]
+    rfm = manifest.gm_to_rfm(gm)
+    assert rfm[0] == {'url': 'globus://ep/a.txt', 'length': 0, 'filename': 'a.txt', 'md5': 'md5sum'}
+    assert manifest.rfm_to_gm(rfm) == gm
+
+
+def test_get_remote_file_manifest_is_cached(tmp_path, settings, monkeypatch):
+    settings.AWS_STAGING_DIR = str(tmp_path)
+    monkeypatch.setattr(manifest, '_manifest_cache', None)
+    key = 'a2b7a8b3-a9a5-4c3c-9a6c-6f3c2f4e0d1a'
+    filename = manifest.api.staging.get_staging_cache().reserve(key)
+    manifest.write_remote_file_manifest(filename, RFM)
+    assert manifest.get_remote_file_manifest(key) == RFM
+    assert manifest.get_remote_file_manifest(key) is manifest.get_remote_file_manifest(key)
+    assert manifest.get_manifest_cache().stats['misses'] == 1
+
+    manifest.invalidate_manifest(key)
+    assert manifest.get_manifest_cache().get(key) is None
+
+
+def test_open_remote_file_manifest_caches_small_manifests(tmp_path, settings, monkeypatch):
+    settings.AWS_STAGING_DIR = str(tmp_path)
+    settings.MANIFEST_CACHE_MAX_ENTRIES = 2
+    monkeypatch.setattr(manifest, '_manifest_cache', None)
+    small, large = 'c2b7a8b3-a9a5-4c3c-9a6c-6f3c2f4e0d1a', 'd2b7a8b3-a9a5-4c3c-9a6c-6f3c2f4e0d1a'
+    for key, rfm in ((small, RFM), (large, RFM * 2)):
+        filename = manifest.api.staging.get_staging_cache().reserve(key)
+        manifest.write_remote_file_manifest(filename, rfm)
+    entries = manifest.open_remote_file_manifest(small)
+    next(entries)
+    # Partially read manifests aren't cached
+    assert manifest.get_manifest_cache().get(small) is None
+    assert list(entries) == RFM[1:]
+    assert manifest.get_manifest_cache().get(small) == RFM
+    assert list(manifest.open_remote_file_manifest(large)) == RFM * 2
+    assert manifest.get_manifest_cache().get(large) is None
+
+
+def test_iter_transfer_items(tmp_path, settings, monkeypatch):
+    settings.AWS_STAGING_DIR = str(tmp_path)
+    monkeypatch.setattr(manifest, '_manifest_cache', None)
+    key = 'b2b7a8b3-a9a5-4c3c-9a6c-6f3c2f4e0d1a'
+    stored = [dict(RFM[0], url={'url': RFM[0]['url'], 'endpoint': 'ep', 'path': '/file1.txt'}), RFM[1]]
+    filename = manifest.api.staging.get_staging_cache().reserve(key)
+    manifest.write_remote_file_manifest(filename, stored)
+    items = list(manifest.iter_transfer_items(key))
+    assert items[0]['source_ref'] == {'url': RFM[0]['url'], 'endpoint': 'ep', 'path': '/file1.txt'}
+    assert items[1]['source_ref'] == {'url': RFM[1]['url'], 'path': '/share/godata/file2.txt',
+                                      'endpoint': 'ddb59aef-6d04-11e5-ba46-22000b92c6ec'}
+    assert [i['dest_path'] for i in items] == ['file1.txt', 'file2.txt']
+
+
+@pytest.mark.django_db
+def test_upload_manifest_retries(tmp_path, settings, monkeypatch, django_user_model):
+    settings.AWS_STAGING_DIR = str(tmp_path)
+    settings.MANIFEST_UPLOAD_ASYNC = False
+    settings.MANIFEST_UPLOAD_BACKOFF = 0
+    uploads = Mock(side_effect=[Exception('S3 is down'), None])
+    monkeypatch.setattr(manifest.api.s3, 'upload', uploads)
+    user = django_user_model.objects.create(username='bob@globus.org')
+    model = Manifest.objects.create(user=user, upload_state=Manifest.UPLOAD_PENDING)
+
+    manifest.upload_remote_file_manifest(model.id, RFM)
+    model.refresh_from_db()
+    assert model.upload_state == Manifest.UPLOAD_SUCCEEDED
+    assert model.upload_attempts == 2
+    assert not manifest.api.staging.get_staging_cache().is_pinned(model.id)
@@ -0,0 +1,73 @@
+import datetime
+import json
+import time
+import uuid
+from unittest.mock import Mock
+
+import pytest
+from django.utils import timezone
+
+import api.auth
+import api.poller
+import api.transfer
+from api.models import ConciergeToken, Transfer
+
+
+@pytest.fixture
+def ctoken(django_user_model, settings):
+    user = django_user_model.objects.create(username='bob@globus.org')
+    now = time.time()
+    return ConciergeToken.objects.create(
+        id='mock_concierge_token', user=user, issued_at=now, expires_at=now + 60,
+        last_introspection=now, scope=settings.CONCIERGE_SCOPE,
+        dependent_tokens_cache=json.dumps({settings.TRANSFER_SCOPE: {'access_token': 'tok'}}),
+    )
+
+
+def task(status):
+    return {
+        'status': status, 'source_endpoint_id': None, 'source_endpoint_display_name': 'src',
+        'source_endpoint': 'src', 'destination_endpoint_id': None,
+        'destination_endpoint_display_name': 'dest', 'destination_endpoint': 'dest',
+        'files': 1, 'directories': 0, 'bytes_transferred': 4, 'effective_bytes_per_second': 1,
+        'completion_time': None,
+    }
+
+
+@pytest.mark.django_db
+def test_poll_transfers(ctoken, monkeypatch):
+    monkeypatch.setattr(api.transfer, 'get_tasks', Mock(return_value=[task('SUCCEEDED')]))
+    active = Transfer.objects.create(task_id=uuid.uuid4(), submission_id=uuid.uuid4(),
+                                     user=ctoken.user, status='ACTIVE')
+    Transfer.objects.create(task_id=uuid.uuid4(), submission_id=uuid.uuid4(),
+                            user=ctoken.user, status='FAILED')
+    assert api.poller.poll_transfers() == 1
+    active.refresh_from_db()
+    assert active.status == 'SUCCEEDED'
+    assert active.last_polled is not None
+    # Nothing is left to poll
+    assert api.poller.poll_transfers() == 0
+
+
+@pytest.mark.django_db
+def test_poll_interval_grows_with_age(ctoken, settings):
+    settings.TRANSFER_POLL_MIN_INTERVAL = 10
+    settings.TRANSFER_POLL_MAX_INTERVAL = 600
+    transfer = Transfer(task_id=uuid.uuid4(), submission_id=uuid.uuid4(), user=ctoken.user,
+                        status='ACTIVE', start_time=timezone.now())
+    for age, interval in [(0, 10), (60 * 10, 60), (60 * 60 * 24, 600)]:
+        now = transfer.start_time + datetime.timedelta(seconds=age)
+        transfer.schedule_next_poll(now)
+        assert transfer.next_poll - now == datetime.timedelta(seconds=interval)
+
+
+@pytest.mark.django_db
+def test_refresh_dependent_tokens(ctoken, monkeypatch, settings):
+    monkeypatch.setattr(api.auth, 'refresh_dependent_tokens', Mock())
+    ctoken.dependent_tokens_expire_at = time.time() + settings.GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN * 2
+    ctoken.save()
+    assert api.poller.refresh_dependent_tokens() == 0
+    ctoken.dependent_tokens_expire_at = time.time() + 1
+    ctoken.save()
+    assert api.poller.refresh_dependent_tokens() == 1
+    api.auth.refresh_dependent_tokens.assert_called_once_with(ctoken.id)
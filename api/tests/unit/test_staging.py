@@ -0,0 +1,96 @@
+import os
+import time
+from unittest.mock import Mock
+
+import pytest
+
+import api.s3
+from api.staging import STALE_TMP_AGE, StagingCache
+
+
+def write(cache, key, size, age=0):
+    path = cache.reserve(key)
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    cache.add(key)
+    return path
+
+
+def test_sharded_path(tmp_path):
+    cache = StagingCache(str(tmp_path), 100)
+    assert cache.path('abcdef') == os.path.join(str(tmp_path), 'ab', 'cd', 'abcdef')
+
+
+def test_lookup_hit_and_miss(tmp_path):
+    cache = StagingCache(str(tmp_path), 100)
+    assert cache.lookup('abcdef') is None
+    path = write(cache, 'abcdef', 10)
+    assert cache.lookup('abcdef') == path
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+
+
+def test_lookup_moves_legacy_files(tmp_path):
+    (tmp_path / 'abcdef').write_text('legacy')
+    cache = StagingCache(str(tmp_path), 100)
+    assert cache.lookup('abcdef') == cache.path('abcdef')
+    assert not (tmp_path / 'abcdef').exists()
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = StagingCache(str(tmp_path), 100, low_water=0.5)
+    write(cache, 'aaaaaa', 40, age=30)
+    write(cache, 'bbbbbb', 40, age=20)
+    cache.lookup('aaaaaa')
+    write(cache, 'cccccc', 40, age=0)
+    assert cache.lookup('bbbbbb') is None
+    assert cache.lookup('aaaaaa') is None
+    assert cache.lookup('cccccc')
+    assert cache.stats['evictions'] == 2
+
+
+def test_pinned_files_are_not_evicted(tmp_path):
+    cache = StagingCache(str(tmp_path), 100, low_water=0.5)
+    write(cache, 'aaaaaa', 40, age=30)
+    cache.pin('aaaaaa')
+    write(cache, 'bbbbbb', 40, age=20)
+    write(cache, 'cccccc', 40, age=0)
+    assert cache.lookup('aaaaaa')
+    assert cache.lookup('bbbbbb') is None
+    cache.unpin('aaaaaa')
+    assert not cache.is_pinned('aaaaaa')
+
+
+def test_lookup_legacy_file_moved_by_another_process(tmp_path, monkeypatch):
+    (tmp_path / 'abcdef').write_text('legacy')
+    cache = StagingCache(str(tmp_path), 100)
+    replace = os.replace
+
+    def replace_twice(src, dst):
+        replace(src, dst)
+        raise FileNotFoundError(src)
+    monkeypatch.setattr(os, 'replace', replace_twice)
+    assert cache.lookup('abcdef') == cache.path('abcdef')
+
+
+def test_stale_tmp_files_are_evicted(tmp_path):
+    cache = StagingCache(str(tmp_path), 100, low_water=0.5)
+    stale = write(cache, 'aaaaaa.1234.tmp', 40, age=STALE_TMP_AGE + 60)
+    fresh = write(cache, 'bbbbbb.1234.tmp', 40, age=0)
+    write(cache, 'cccccc', 40, age=0)
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+
+
+def test_failed_download_removes_tmp_file(tmp_path, settings, monkeypatch):
+    settings.AWS_STAGING_DIR = str(tmp_path)
+    client = Mock()
+    client.download_file.side_effect = OSError('Connection reset')
+    monkeypatch.setattr(api.s3, 'get_s3_client', Mock(return_value=client))
+    with pytest.raises(OSError):
+        api.s3.download('abcdef')
+    tmp_file = client.download_file.call_args[0][2]
+    assert tmp_file.endswith('.tmp')
+    assert os.listdir(os.path.dirname(tmp_file)) == []
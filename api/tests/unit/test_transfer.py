@@ -0,0 +1,196 @@
+import threading
+import time
+import uuid
+from unittest.mock import Mock, create_autospec
+
+import globus_sdk
+import globus_sdk.exc
+import pytest
+
+import api.transfer
+from api.exc import GlobusTransferException, InvalidGlobusURL
+
+
+@pytest.fixture
+def mock_tc(monkeypatch):
+    tc = Mock()
+    monkeypatch.setattr(api.transfer, 'get_transfer_client', Mock(return_value=tc))
+    return tc
+
+
+def test_get_tasks_batches_task_list(monkeypatch, settings):
+    settings.GLOBUS_TASK_LIST_BATCH_SIZE = 2
+    # Autospec checks calls against the installed SDK's signatures
+    mock_tc = create_autospec(globus_sdk.TransferClient, instance=True)
+    monkeypatch.setattr(api.transfer, 'get_transfer_client', Mock(return_value=mock_tc))
+    task_ids = [str(uuid.uuid4()) for _ in range(3)]
+    mock_tc.task_list.side_effect = lambda **kwargs: [
+        {'task_id': tid} for tid in kwargs['filter'].split(':')[1].split(',')
+    ]
+    tasks = api.transfer.get_tasks(Mock(), task_ids)
+    assert [t['task_id'] for t in tasks] == task_ids
+    assert mock_tc.task_list.call_count == 2
+    assert not mock_tc.get_task.called
+
+
+def test_get_tasks_fetches_missing_tasks(mock_tc):
+    task_ids = [str(uuid.uuid4()) for _ in range(3)]
+    mock_tc.task_list.return_value = [{'task_id': task_ids[1]}]
+    mock_tc.get_task.side_effect = lambda tid: {'task_id': tid, 'fetched': True}
+    tasks = api.transfer.get_tasks(Mock(), task_ids)
+    assert [t['task_id'] for t in tasks] == task_ids
+    assert [t.get('fetched', False) for t in tasks] == [True, False, True]
+
+
+def test_get_transfer_client_is_cached():
+    ctoken = Mock(id=str(uuid.uuid4()), expires_at=time.time() + 60)
+    ctoken.get_token.return_value = 'transfer_token'
+    tc = api.transfer.get_transfer_client(ctoken)
+    assert api.transfer.get_transfer_client(ctoken) is tc
+
+    api.transfer.evict_transfer_clients(ctoken.id)
+    assert api.transfer.get_transfer_client(ctoken) is not tc
+
+
+def test_get_transfer_client_new_dependent_token():
+    ctoken = Mock(id=str(uuid.uuid4()), expires_at=time.time() + 60)
+    ctoken.get_token.return_value = 'transfer_token'
+    tc = api.transfer.get_transfer_client(ctoken)
+    ctoken.get_token.return_value = 'refreshed_transfer_token'
+    assert api.transfer.get_transfer_client(ctoken) is not tc
+
+
+def test_autoactivate_endpoints_is_cached(mock_tc):
+    auth = Mock(user_id=uuid.uuid4())
+    eps = [str(uuid.uuid4()), str(uuid.uuid4())]
+    mock_tc.endpoint_autoactivate.return_value = {'code': 'AutoActivated.CachedCredential',
+                                                  'expires_in': 60 * 60 * 24}
+    api.transfer.autoactivate_endpoints(auth, mock_tc, eps)
+    api.transfer.autoactivate_endpoints(auth, mock_tc, eps)
+    assert mock_tc.endpoint_autoactivate.call_count == 2
+
+
+def test_autoactivate_endpoints_failures_are_retried(mock_tc):
+    auth = Mock(user_id=uuid.uuid4())
+    mock_tc.endpoint_autoactivate.return_value = {'code': 'AutoActivationFailed', 'expires_in': 0}
+    api.transfer.autoactivate_endpoints(auth, mock_tc, ['ep'])
+    api.transfer.autoactivate_endpoints(auth, mock_tc, ['ep'])
+    assert mock_tc.endpoint_autoactivate.call_count == 2
+
+
+class FakeTransferData(dict):
+    def __init__(self, tc, src, dst):
+        super().__init__(src=src, DATA=[])
+
+    def add_item(self, src, dest, **kwargs):
+        self['DATA'].append((src, dest))
+
+
+class FakeAPIError(globus_sdk.TransferAPIError):
+    def __init__(self, http_status, code, message):
+        self.http_status, self.code, self.message = http_status, code, message
+
+
+def test_transfer_manifest_reports_partial_failures(mock_tc, monkeypatch):
+    monkeypatch.setattr(api.transfer, 'autoactivate_endpoint', Mock())
+    monkeypatch.setattr(globus_sdk, 'TransferData', FakeTransferData)
+    error = FakeAPIError(404, 'NotFound', 'Nope')
+
+    def submit_transfer(transfer_data):
+        if transfer_data['src'] == 'bad_ep':
+            raise error
+        return Mock(data={'task_id': 'task', 'code': 'Accepted'})
+    mock_tc.submit_transfer.side_effect = submit_transfer
+    manifest = {'manifest_items': [
+        {'source_ref': {'endpoint': ep, 'path': '/foo.txt'}, 'dest_path': 'foo.txt'}
+        for ep in ('good_ep', 'bad_ep')
+    ]}
+    result = api.transfer.transfer_manifest(Mock(), manifest, {'endpoint': 'dest', 'path': '/'})
+    assert [t['task_id'] for t in result['transfers']] == ['task']
+    assert result['errors'] == [{'endpoint': 'bad_ep', 'status_code': 400,
+                                 'code': 'NotFound', 'message': 'Nope'}]
+
+    mock_tc.submit_transfer.side_effect = error
+    with pytest.raises(GlobusTransferException):
+        api.transfer.transfer_manifest(Mock(), manifest, {'endpoint': 'dest', 'path': '/'})
+
+
+def test_transfer_manifest_submits_batches(mock_tc, monkeypatch, settings):
+    settings.GLOBUS_TRANSFER_BATCH_SIZE = 2
+    monkeypatch.setattr(api.transfer, 'autoactivate_endpoint', Mock())
+    monkeypatch.setattr(globus_sdk, 'TransferData', FakeTransferData)
+    mock_tc.submit_transfer.side_effect = lambda td: Mock(data={'task_id': td['DATA']})
+    manifest = {'manifest_items': [
+        {'source_ref': {'endpoint': 'ep', 'path': f'/foo{i}.txt'}, 'dest_path': f'foo{i}.txt'}
+        for i in range(5)
+    ] + [{'source_ref': {'endpoint': 'ep', 'path': '/abs/'}, 'dest_path': '/abs/'}]}
+    result = api.transfer.transfer_manifest(Mock(), manifest, {'endpoint': 'dest', 'path': '/~/dest'})
+    items = sorted(i for t in result['transfers'] for i in t['task_id'])
+    assert len(result['transfers']) == 3
+    assert items == sorted([(f'/foo{i}.txt', f'/~/dest/foo{i}.txt') for i in range(5)] + [('/abs/', '/abs/')])
+
+
+def test_transfer_manifest_keeps_tasks_after_read_errors(mock_tc, monkeypatch, settings):
+    settings.GLOBUS_TRANSFER_BATCH_SIZE = 1
+    monkeypatch.setattr(api.transfer, 'autoactivate_endpoint', Mock())
+    monkeypatch.setattr(globus_sdk, 'TransferData', FakeTransferData)
+    mock_tc.submit_transfer.side_effect = lambda td: Mock(data={'task_id': td['DATA'][0][0]})
+
+    def items(count):
+        for i in range(count):
+            yield {'source_ref': {'endpoint': 'ep', 'path': f'/foo{i}.txt'}, 'dest_path': f'foo{i}.txt'}
+        raise ValueError('Corrupt manifest entry')
+    result = api.transfer.transfer_manifest(Mock(), {'manifest_items': items(3)}, {'endpoint': 'dest', 'path': '/'})
+    assert sorted(t['task_id'] for t in result['transfers']) == ['/foo0.txt', '/foo1.txt', '/foo2.txt']
+    assert [(e['endpoint'], e['code']) for e in result['errors']] == [(None, 'manifest_unreadable')]
+
+    # Nothing was submitted, so there's nothing to lose by raising
+    with pytest.raises(ValueError):
+        api.transfer.transfer_manifest(Mock(), {'manifest_items': items(0)}, {'endpoint': 'dest', 'path': '/'})
+
+
+def test_transfer_manifest_activates_endpoints_concurrently(mock_tc, monkeypatch):
+    monkeypatch.setattr(globus_sdk, 'TransferData', FakeTransferData)
+    # Every source must be activating at once for the barrier to open
+    barrier = threading.Barrier(3, timeout=5)
+
+    def endpoint_autoactivate(ep):
+        if ep == 'dest':
+            return {'code': 'AutoActivated.CachedCredential', 'expires_in': -1}
+        barrier.wait()
+        if ep == 'bad_ep':
+            raise FakeAPIError(403, 'PermissionDenied', 'Nope')
+        return {'code': 'AutoActivated.CachedCredential', 'expires_in': -1}
+    mock_tc.endpoint_autoactivate.side_effect = endpoint_autoactivate
+    mock_tc.submit_transfer.side_effect = lambda td: Mock(data={'task_id': td['src']})
+    manifest = {'manifest_items': [
+        {'source_ref': {'endpoint': ep, 'path': '/foo.txt'}, 'dest_path': 'foo.txt'}
+        for ep in ('ep1', 'ep2', 'bad_ep', 'ep1')
+    ]}
+    result = api.transfer.transfer_manifest(Mock(user_id=str(uuid.uuid4())), manifest,
+                                            {'endpoint': 'dest', 'path': '/'})
+    assert sorted(t['task_id'] for t in result['transfers']) == ['ep1', 'ep2']
+    assert [e['endpoint'] for e in result['errors']] == ['bad_ep']
+    assert mock_tc.endpoint_autoactivate.call_count == 4
+
+
+@pytest.mark.parametrize('url, path', [
+    ('globus://{ep}/foo.txt', '/foo.txt'),
+    ('https://{ep}.data.globus.org/foo/', '/foo/'),
+    ('{ep}.e.globus.org', ''),
+    ('globus://{ep}/foo;bar', '/foo;bar'),
+])
+def test_parse_globus_url(url, path):
+    ep = str(uuid.uuid4())
+    url = url.format(ep=ep)
+    assert api.transfer.parse_globus_url(url) == {'url': url, 'endpoint': ep, 'path': path}
+
+
+def test_parse_globus_url_caches_endpoints():
+    ep = str(uuid.uuid4())
+    hits = api.transfer._resolve_endpoint.cache_info().hits
+    for i in range(3):
+        api.transfer.parse_globus_url(f'globus://{ep}/foo{i}.txt')
+    assert api.transfer._resolve_endpoint.cache_info().hits == hits + 2
+    with pytest.raises(InvalidGlobusURL):
+        api.transfer.parse_globus_url('globus://example.com/foo.txt')
@@ -0,0 +1,130 @@
+import threading
+
+import pytest
+
+from api import utils
+from api.cache import ListingCache
+
+EP = 'ddb59aef-6d04-11e5-ba46-22000b92c6ec'
+
+
+class MockLsClient():
+    """Serves 'operation_ls' from a dict of paths to directory entries"""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.calls = []
+
+    def operation_ls(self, endpoint, path=None, offset=0, limit=None):
+        self.calls.append((endpoint, path, offset))
+        entries = self.tree[path]
+        if isinstance(entries, dict):
+            return dict(DATA_TYPE='file', **entries)
+        page = entries[offset:offset + limit]
+        return {'DATA_TYPE': 'file_list', 'DATA': page, 'total': len(entries)}
+
+
+@pytest.fixture(autouse=True)
+def no_listing_cache(settings):
+    settings.GLOBUS_LS_CACHE_TTL = 0
+
+
+def test_walk_globus_path():
+    client = MockLsClient({
+        '/share': [{'type': 'file', 'name': 'a.txt', 'size': 1},
+                   {'type': 'dir', 'name': 'sub', 'size': 0}],
+        '/share/sub': [{'type': 'file', 'name': 'b.txt', 'size': 2}],
+    })
+    files = utils._walk_globus_path(client, EP, '/share')
+    assert sorted(f['url'] for f in files) == [
+        f'globus://{EP}:/share/a.txt',
+        f'globus://{EP}:/share/sub/b.txt',
+    ]
+
+
+def test_walker_follows_pages():
+    entries = [{'type': 'file', 'name': f'{i}.txt', 'size': i}
+               for i in range(5)]
+    client = MockLsClient({'/data': entries})
+    walker = utils.GlobusPathWalker(client, page_size=2)
+    root = walker.add(EP, '/data')
+    assert len(walker.walk()[root]) == 5
+    assert [offset for _, _, offset in client.calls] == [0, 2, 4]
+
+
+def test_walker_output_is_sorted():
+    tree = {
+        '/d': [{'type': 'dir', 'name': name, 'size': 0} for name in 'abc'],
+        '/d/a': [{'type': 'file', 'name': 'z.txt', 'size': 1}],
+        '/d/b': [{'type': 'file', 'name': 'y.txt', 'size': 2},
+                 {'type': 'file', 'name': 'x.txt', 'size': 3}],
+        '/d/c': [{'type': 'file', 'name': 'w.txt', 'size': 4}],
+    }
+    done = threading.Event()
+
+    class ReversedClient(MockLsClient):
+        """'/d/a' finishes listing last"""
+        def operation_ls(self, endpoint, path=None, **kwargs):
+            if path == '/d/a':
+                done.wait(1)
+            elif path == '/d/c':
+                done.set()
+            return super().operation_ls(endpoint, path=path, **kwargs)
+
+    walker = utils.GlobusPathWalker(ReversedClient(tree))
+    root = walker.add(EP, '/d')
+    assert [f['url'] for f in walker.walk()[root]] == [
+        f'globus://{EP}:/d/a/z.txt',
+        f'globus://{EP}:/d/b/x.txt',
+        f'globus://{EP}:/d/b/y.txt',
+        f'globus://{EP}:/d/c/w.txt',
+    ]
+
+
+def test_walker_resumes_from_state():
+    client = MockLsClient({
+        '/a': [{'type': 'dir', 'name': 'b', 'size': 0}],
+        '/a/b': [{'type': 'file', 'name': 'c.txt', 'size': 3}],
+    })
+    states = []
+    walker = utils.GlobusPathWalker(client, progress=lambda w: states.append(w.get_state()))
+    walker.add(EP, '/a')
+    walker.walk()
+    assert states[0]['pending'] == [[0, EP, '/a/b', None]]
+    resumed = utils.GlobusPathWalker.from_state(client, states[0])
+    assert resumed.walk() == walker.results == [[
+        {'url': f'globus://{EP}:/a/b/c.txt', 'filename': 'c.txt', 'size': 3}
+    ]]
+
+
+def test_walker_uses_listing_cache():
+    tree = {
+        '/a': [{'type': 'dir', 'name': 'b', 'size': 0, 'last_modified': 't1'}],
+        '/a/b': [{'type': 'file', 'name': 'c.txt', 'size': 3}],
+    }
+    client, cache = MockLsClient(tree), ListingCache(60, 100)
+    first = utils.GlobusPathWalker(client, cache=cache, identity=1)
+    first.add(EP, '/a')
+    second = utils.GlobusPathWalker(client, cache=cache, identity=1)
+    second.add(EP, '/a')
+    assert first.walk() == second.walk()
+    assert len(client.calls) == 2
+
+    # A new modification time on /a/b in its parent listing is a cache miss
+    cache.set(1, EP, '/a', {'DATA_TYPE': 'file_list', 'DATA': [
+        {'type': 'dir', 'name': 'b', 'size': 0, 'last_modified': 't2'}
+    ]})
+    third = utils.GlobusPathWalker(client, cache=cache, identity=1)
+    third.add(EP, '/a')
+    third.walk()
+    assert client.calls[-1] == (EP, '/a/b', 0)
+
+
+def test_walker_listing_cache_is_per_identity():
+    tree = {'/a': [{'type': 'file', 'name': 'c.txt', 'size': 3}]}
+    client, cache = MockLsClient(tree), ListingCache(60, 100)
+    for identity in (1, 2, None):
+        walker = utils.GlobusPathWalker(client, cache=cache, identity=identity)
+        walker.add(EP, '/a')
+        walker.walk()
+    assert len(client.calls) == 3
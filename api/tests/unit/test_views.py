@@ -1,7 +1,29 @@
+import datetime
+import gzip
+import importlib
+import json
+import uuid
+from unittest.mock import Mock
+
 import pytest
+from django.apps import apps
+from django.db import IntegrityError
 from django.urls import reverse
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
 from rest_framework.test import APIClient
 
+import api.manifest
+import api.staging
+from api.models import Manifest, ManifestTransfer, Transfer
+from api.views import TransferManifestActionViewSet
+from gap.models import Action
+from gap.serializers import ActionCreateSerializer, DuplicateRequestId
+from gap.views import ActionViewSet
+from api.serializers.manifest import GlobusManifestSerializer, RemoteFileManifestSerializer
+
 
 @pytest.mark.django_db
 def test_root():
@@ -21,3 +43,198 @@ def test_unauthenticated_api_request():
 def test_bag_list(api_cli):
     response = api_cli.get(reverse('bag-list'))
     assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_manifest_list_is_paginated(django_user_model, settings, django_assert_max_num_queries):
+    settings.REST_FRAMEWORK = dict(settings.REST_FRAMEWORK, DEFAULT_AUTHENTICATION_CLASSES=[])
+    alice = django_user_model.objects.create(username='alice@globus.org')
+    bob = django_user_model.objects.create(username='bob@globus.org')
+    for user in [alice, bob] * 3:
+        Manifest.objects.create(user=user)
+    client = APIClient()
+    with django_assert_max_num_queries(2):
+        response = client.get('/api/manifest/', {'page_size': 4})
+    assert response.status_code == 200
+    assert len(response.data['results']) == 4
+    response = client.get(response.data['next'])
+    assert len(response.data['results']) == 2
+    assert response.data['next'] is None
+
+    response = client.get('/api/manifest/', {'user': 'alice@globus.org'})
+    assert {m['user'] for m in response.data['results']} == {'alice@globus.org'}
+    assert client.get('/api/manifest/', {'created_after': 'yesterday'}).status_code == 400
+
+
+@pytest.mark.django_db
+def test_backfill_created_is_unique(django_user_model):
+    migration = importlib.import_module('api.migrations.0014_backfill_created')
+    alice = django_user_model.objects.create(username='alice@globus.org')
+    for _ in range(3):
+        Manifest.objects.create(user=alice)
+    Manifest.objects.update(created=timezone.now())
+    migration.backfill_created(apps, None)
+    assert len({m.created for m in Manifest.objects.all()}) == 3
+
+
+@pytest.mark.django_db
+def test_transfer_list_only_shows_own_transfers(django_user_model, django_assert_max_num_queries):
+    alice = django_user_model.objects.create(username='alice@globus.org')
+    bob = django_user_model.objects.create(username='bob@globus.org')
+    for user in (alice, bob, alice, alice):
+        ManifestTransfer.objects.create(user=user, manifest=Manifest.objects.create(user=user))
+    client = APIClient()
+    client.force_authenticate(alice)
+    # Transfers and their prefetched tasks, regardless of the number of rows
+    with django_assert_max_num_queries(2):
+        response = client.get('/api/manifest/transfer/')
+    assert response.status_code == 200
+    assert [t['user'] for t in response.data['results']] == ['alice@globus.org'] * 3
+
+
+@pytest.mark.django_db
+def test_action_status_fails_on_submission_errors(django_user_model, monkeypatch):
+    alice = django_user_model.objects.create(username='alice@globus.org')
+    action = Action.objects.create(creator=alice, display_status='ACTIVE')
+    mt = ManifestTransfer.objects.create(user=alice, manifest=Manifest.objects.create(user=alice),
+                                         action=action, submission_errors='[{"endpoint": "ep"}]')
+    transfer = Transfer.objects.create(task_id=uuid.uuid4(), user=alice, submission_id=uuid.uuid4(),
+                                       status='ACTIVE', next_poll=timezone.now())
+    mt.transfers.add(transfer)
+    monkeypatch.setattr(ActionViewSet, 'status', Mock(return_value=Response({})))
+    client = APIClient()
+    client.force_authenticate(alice)
+    # Transfers which were submitted can still be cancelled until they stop
+    client.get(f'/api/automate/transfer/{action.action_id}/status')
+    action.refresh_from_db()
+    assert action.display_status == 'ACTIVE'
+
+    Transfer.objects.filter(task_id=transfer.task_id).update(status='SUCCEEDED')
+    client.get(f'/api/automate/transfer/{action.action_id}/status')
+    action.refresh_from_db()
+    assert action.display_status == 'FAILED'
+
+
+@pytest.mark.django_db
+def test_transfer_list_refreshes_stale_transfers(django_user_model, monkeypatch):
+    alice = django_user_model.objects.create(username='alice@globus.org')
+    mt = ManifestTransfer.objects.create(user=alice, manifest=Manifest.objects.create(user=alice))
+    mt.transfers.add(Transfer.objects.create(task_id=uuid.uuid4(), user=alice, submission_id=uuid.uuid4(),
+                                             status='ACTIVE',
+                                             next_poll=timezone.now() - datetime.timedelta(hours=1)))
+    monkeypatch.setattr(Transfer, 'update_many', Mock(
+        side_effect=lambda ctoken, transfers: [setattr(t, 'status', 'SUCCEEDED') for t in transfers]))
+    client = APIClient()
+    client.force_authenticate(alice, token=Mock())
+    response = client.get('/api/manifest/transfer/')
+    assert [t['status'] for t in response.data['results']] == ['SUCCEEDED']
+    assert Transfer.update_many.call_count == 1
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('url, serializer_class', [
+    ('/api/manifest/{}/', GlobusManifestSerializer),
+    ('/api/manifest/{}/remote_file_manifest/', RemoteFileManifestSerializer),
+])
+def test_manifest_retrieve_is_streamed(url, serializer_class, django_user_model, settings, tmp_path):
+    settings.AWS_STAGING_DIR = str(tmp_path)
+    settings.MANIFEST_STREAM_CHUNK_SIZE = 2
+    ep = str(uuid.uuid4())
+    rfm = [{'url': {'url': f'globus://{ep}/foo{i}.txt', 'endpoint': ep, 'path': f'/foo{i}.txt'},
+            'filename': f'foo{i}.txt', 'length': i, 'md5': 'a' * 32} for i in range(5)]
+    manifest = Manifest.objects.create(user=django_user_model.objects.create(username='alice@globus.org'))
+    filename = api.staging.get_staging_cache().reserve(manifest.id)
+    api.manifest.write_remote_file_manifest(filename, rfm)
+    expected = JSONRenderer().render(serializer_class(manifest).data)
+
+    client = APIClient()
+    response = client.get(url.format(manifest.id))
+    assert response.streaming
+    assert b''.join(response.streaming_content) == expected
+    assert set(json.loads(expected)) <= {'id', 'manifest_id', 'user', 'remote_file_manifest', 'manifest_items'}
+    response = client.get(url.format(manifest.id), HTTP_ACCEPT_ENCODING='gzip')
+    assert response['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(b''.join(response.streaming_content)) == expected
+
+
+@pytest.mark.django_db
+def test_manifest_retrieve_not_modified(django_user_model, monkeypatch):
+    manifest = Manifest.objects.create(user=django_user_model.objects.create(username='alice@globus.org'))
+    monkeypatch.setattr(api.manifest, 'open_remote_file_manifest', Mock(return_value=iter([])))
+    client = APIClient()
+    response = client.get(f'/api/manifest/{manifest.id}/')
+    assert response.status_code == 200
+    assert 'immutable' in response['Cache-Control']
+    etag = response['ETag']
+    assert client.get(f'/api/manifest/{manifest.id}/remote_file_manifest/')['ETag'] != etag
+    assert client.get(f'/api/manifest/{manifest.id}/', HTTP_ACCEPT_ENCODING='gzip')['ETag'] != etag
+
+    api.manifest.open_remote_file_manifest.reset_mock()
+    response = client.get(f'/api/manifest/{manifest.id}/', HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+    assert not api.manifest.open_remote_file_manifest.called
+
+
+@pytest.mark.django_db
+def test_manifest_representation_is_immutable(django_user_model, monkeypatch):
+    manifest = Manifest.objects.create(user=django_user_model.objects.create(username='alice@globus.org'),
+                                       upload_state=Manifest.UPLOAD_PENDING)
+    monkeypatch.setattr(api.manifest, 'open_remote_file_manifest', Mock(side_effect=lambda key: iter([])))
+    client = APIClient()
+    url = f'/api/manifest/{manifest.id}/remote_file_manifest/'
+    before = client.get(url)
+    Manifest.objects.filter(id=manifest.id).update(upload_state=Manifest.UPLOAD_SUCCEEDED, upload_attempts=1)
+    after = client.get(url)
+    assert before['ETag'] == after['ETag']
+    assert b''.join(before.streaming_content) == b''.join(after.streaming_content)
+
+
+class ActionIdSerializer(serializers.Serializer):
+    action_id = serializers.UUIDField()
+
+
+@pytest.mark.django_db
+def test_action_run_is_idempotent(django_user_model, monkeypatch):
+    alice = django_user_model.objects.create(username='alice@globus.org')
+    action = Action.objects.create(creator=alice, request_id='my-request')
+    monkeypatch.setattr(TransferManifestActionViewSet, 'create', Mock())
+    monkeypatch.setattr(TransferManifestActionViewSet, 'status_serializer_class', ActionIdSerializer)
+    client = APIClient()
+    client.force_authenticate(alice)
+    response = client.post('/api/automate/transfer/run', {'request_id': 'my-request', 'body': {}}, format='json')
+    assert response.status_code == 200
+    assert response.data['action_id'] == str(action.action_id)
+    assert not TransferManifestActionViewSet.create.called
+
+    # Another run with the same request_id created the action after the lookup
+    TransferManifestActionViewSet.create.side_effect = DuplicateRequestId('my-request')
+    monkeypatch.setattr(TransferManifestActionViewSet, 'get_previous_action', Mock(side_effect=[None, action]))
+    response = client.post('/api/automate/transfer/run', {'request_id': 'my-request', 'body': {}}, format='json')
+    assert response.status_code == 200
+    assert response.data['action_id'] == str(action.action_id)
+
+    # Any other error is not mistaken for a replay
+    TransferManifestActionViewSet.get_previous_action.side_effect = None
+    TransferManifestActionViewSet.get_previous_action.return_value = None
+    TransferManifestActionViewSet.create.side_effect = IntegrityError
+    with pytest.raises(IntegrityError):
+        client.post('/api/automate/transfer/run', {'request_id': 'another-request', 'body': {}}, format='json')
+
+
+@pytest.mark.django_db
+def test_action_create_conflicts_on_request_id(django_user_model):
+    alice = django_user_model.objects.create(username='alice@globus.org')
+    Action.objects.create(creator=alice, request_id='my-request')
+    body_serializer_class = Mock()
+    serializer = ActionCreateSerializer(context={'request': Mock(user=alice),
+                                                 'view': Mock(body_serializer_class=body_serializer_class)})
+    with pytest.raises(DuplicateRequestId):
+        serializer.create(Mock(request_id='my-request', release_after=60, body={}))
+    assert not body_serializer_class.called
+
+    # Errors saving the body propagate, after the action itself was created
+    body_serializer_class.return_value.create.side_effect = IntegrityError
+    with pytest.raises(IntegrityError):
+        serializer.create(Mock(request_id='another-request', release_after=60, body={}))
+    assert Action.objects.filter(creator=alice, request_id='another-request').exists()
@@ -1,20 +1,126 @@
-import os
+import functools
 import logging
+import re
+import threading
+import time
+import urllib
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from django.conf import settings
 import globus_sdk
 
-from api.exc import GlobusTransferException
+import api.http
+from api.cache import LRUCache
+from api.exc import ConciergeException, GlobusTransferException, InvalidGlobusURL, NoDataToTransfer
 
 log = logging.getLogger(__name__)
 
+_transfer_clients = None
+_transfer_clients_lock = threading.Lock()
+_activations = None
+_activations_lock = threading.Lock()
+
+GCS_V4_HTTP_SUFFIXES = ('.data.globus.org', '.e.globus.org')
+GCS_V5_HTTP_SUFFIXES = ('.dn.glob.us',)
+GLOBUS_URL_PROTOCOLS = ('https', 'http', 'globus')
+# Plain URLs which urlparse would split the same way. Anything else (ports,
+# queries, params, unusual characters) is parsed by urlparse instead.
+_SIMPLE_URL = re.compile(r'(?:(https?|globus)://)?([A-Za-z0-9._~-]+)(/[^;?#\s\x00-\x1f]*)?')
+
 
 def get_transfer_client(ctoken_obj):
     """
-    Get a transfer client from a ConciergeToken (request.auth obj)
+    Get a transfer client from a ConciergeToken (request.auth obj). Clients
+    are cached per token and dependent transfer token until the token
+    expires, and share one HTTP connection pool.
     """
     transfer_token = ctoken_obj.get_token(settings.TRANSFER_SCOPE)
-    transfer_authorizer = globus_sdk.AccessTokenAuthorizer(transfer_token)
-    return globus_sdk.TransferClient(authorizer=transfer_authorizer)
+    key = (ctoken_obj.id, transfer_token)
+    clients = get_transfer_client_cache()
+    tc = clients.get(key)
+    if tc is None:
+        transfer_authorizer = globus_sdk.AccessTokenAuthorizer(transfer_token)
+        tc = globus_sdk.TransferClient(authorizer=transfer_authorizer)
+        api.http.share_connection_pool(tc)
+        ttl = ctoken_obj.expires_at - time.time()
+        if ttl > 0:
+            clients.set(key, tc, ttl=ttl)
+    return tc
+
+
+def get_transfer_client_cache():
+    global _transfer_clients
+    with _transfer_clients_lock:
+        if _transfer_clients is None:
+            _transfer_clients = LRUCache(settings.GLOBUS_TRANSFER_CLIENT_CACHE_SIZE)
+        return _transfer_clients
+
+
+def evict_transfer_clients(token_id):
+    """Drop all cached transfer clients for a token, for example after it
+    has been revoked."""
+    clients = get_transfer_client_cache()
+    for key in clients.keys():
+        if key[0] == token_id:
+            clients.delete(key)
+
+
+def autoactivate_endpoints(auth, tc, endpoints):
+    """
+    Auto-activate Globus endpoints for the user of auth (a ConciergeToken).
+    Successful activations are cached per user until shortly before they
+    expire, so repeat calls skip endpoints activated recently. Activations
+    which are needed run concurrently.
+    """
+    cache = get_activation_cache()
+    needed = {str(ep) for ep in endpoints
+              if cache.get((auth.user_id, str(ep))) is None}
+    if not needed:
+        return
+    workers = min(len(needed), settings.GLOBUS_ACTIVATION_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(autoactivate_endpoint, auth, tc, ep) for ep in needed]
+        for future in as_completed(futures):
+            future.result()
+
+
+def autoactivate_endpoint(auth, tc, endpoint):
+    """Auto-activate a single endpoint, unless it was activated recently.
+    Raises a GlobusTransferException if activation fails."""
+    cache = get_activation_cache()
+    endpoint = str(endpoint)
+    if cache.get((auth.user_id, endpoint)) is not None:
+        return
+    log.debug(f'Auto-activating Globus endpoint: {endpoint}')
+    try:
+        result = tc.endpoint_autoactivate(endpoint)
+    except globus_sdk.TransferAPIError as tapie:
+        raise GlobusTransferException(f'Failed to auto-activate endpoint {endpoint}',
+                                      status_code=400, code=tapie.code)
+    ttl = get_activation_ttl(result)
+    if ttl > 0:
+        cache.set((auth.user_id, endpoint), result['code'], ttl=ttl)
+
+
+def get_activation_ttl(result):
+    """Seconds an endpoint_autoactivate result can be trusted for. Failed
+    activations are never trusted, and activations which never expire
+    (expires_in == -1) are trusted for GLOBUS_ACTIVATION_CACHE_MAX_TTL."""
+    if result['code'] == 'AutoActivationFailed':
+        return 0
+    max_ttl = settings.GLOBUS_ACTIVATION_CACHE_MAX_TTL
+    expires_in = result.get('expires_in', -1)
+    if expires_in == -1:
+        return max_ttl
+    return min(expires_in - settings.GLOBUS_ACTIVATION_EXPIRY_MARGIN, max_ttl)
+
+
+def get_activation_cache():
+    global _activations
+    with _activations_lock:
+        if _activations is None:
+            _activations = LRUCache(settings.GLOBUS_ACTIVATION_CACHE_SIZE)
+        return _activations
 
 
 def submit_transfer(auth, source_endpoint, destination_endpoint, data,
@@ -57,8 +163,37 @@ def get_task(auth, task_id):
 
 
 def get_tasks(auth, task_ids):
+    """
+    Fetch task documents for many tasks, returned in the same order as
+    task_ids. Tasks are fetched with paged 'task_list' calls filtered on
+    up to settings.GLOBUS_TASK_LIST_BATCH_SIZE task ids at a time. Any
+    tasks task_list doesn't return are fetched individually, concurrently.
+    """
+    task_ids = [str(task_id) for task_id in task_ids]
     tc = get_transfer_client(auth)
-    return [tc.get_task(task_id) for task_id in task_ids]
+    if len(task_ids) == 1:
+        return [tc.get_task(task_ids[0])]
+
+    tasks = {}
+    batch_size = settings.GLOBUS_TASK_LIST_BATCH_SIZE
+    # globus_sdk<3 pages task_list by num_results, later versions by limit
+    limit_param = 'num_results' if int(globus_sdk.__version__.split('.')[0]) < 3 else 'limit'
+    for start in range(0, len(task_ids), batch_size):
+        batch = task_ids[start:start + batch_size]
+        try:
+            for task in tc.task_list(filter='task_id:' + ','.join(batch),
+                                     **{limit_param: len(batch)}):
+                tasks[task['task_id']] = task
+        except globus_sdk.TransferAPIError as tapie:
+            log.warning(f'Failed to list tasks, fetching them one by one: {tapie}')
+
+    missing = [task_id for task_id in task_ids if task_id not in tasks]
+    if missing:
+        log.debug(f'Fetching {len(missing)} tasks individually')
+        workers = min(len(missing), settings.GLOBUS_TASK_FETCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            tasks.update(zip(missing, pool.map(tc.get_task, missing)))
+    return [tasks[task_id] for task_id in task_ids]
 
 
 def transfer_manifest(auth, globus_manifest, destination):
@@ -67,61 +202,188 @@ def transfer_manifest(auth, globus_manifest, destination):
     a serializer after validation has been completed.
     :param auth: request.auth object which should be a ConciergeToken obj
     :param globus_manifest: api.serializers.manifest.ManifestSerializer
-    :return:
+    :return: dict with 'transfers', a list of submitted transfer results,
+    and 'errors', a list of errors for batches which failed to submit. If
+    none succeeded, the first error is raised as a GlobusTransferException.
     """
-    transfer_kwargs = {}
-    manifest_items = globus_manifest['manifest_items']
-
-    # Activate all endpoints. There may be many source endpoints
-    source_eps = {m['source_ref']['endpoint'] for m in manifest_items}
     tc = get_transfer_client(auth)
-    for ep in set(list(source_eps) + [destination['endpoint']]):
-        log.debug(f'Auto-activating Globus endpoint: {ep}')
+    dest_ep = destination['endpoint']
+    # Same as os.path.join(destination['path'], dest_path), without the
+    # overhead of calling it for every item
+    dest_root = destination['path']
+    dest_prefix = dest_root if not dest_root or dest_root.endswith('/') else dest_root + '/'
+
+    # Items are streamed into one TransferData per source endpoint, which is
+    # submitted as its own task once it holds GLOBUS_TRANSFER_BATCH_SIZE
+    # items. The number of batches in flight is bounded too, so memory stays
+    # flat regardless of the size of the manifest. Endpoints are activated
+    # concurrently in the background as they are first seen, and each
+    # endpoint's activation is waited on before its first submission.
+    batch_size = settings.GLOBUS_TRANSFER_BATCH_SIZE
+    workers = settings.GLOBUS_TRANSFER_SUBMIT_WORKERS
+    batches, activations, failed_eps, futures = {}, {}, set(), {}
+    transfers, errors = [], []
+
+    def collect(done):
+        for future in done:
+            endpoint = futures.pop(future)
+            try:
+                transfers.append(future.result().data)
+                log.debug(f'Submitted transfer from {endpoint}')
+            except globus_sdk.exc.GlobusError as ge:
+                errors.append(get_submission_error(endpoint, ge))
+
+    def activate(endpoint):
+        if endpoint not in activations:
+            activations[endpoint] = activation_pool.submit(autoactivate_endpoint, auth, tc, endpoint)
+
+    def submit(endpoint):
+        transfer_data = batches.pop(endpoint)
+        # Nothing can be transferred if the destination can't be activated
+        activations[dest_ep].result()
         try:
-            tc.endpoint_autoactivate(ep)
-        except globus_sdk.exc.TransferAPIError as tapie:
-            raise GlobusTransferException(f'Failed to auto-activate endpoint {ep}',
-                                          status_code=400, code=tapie.code)
-
-    # Collect all files and start the transfer
-    transfer_data = dict()
-    for item in manifest_items:
-        endpoint = item['source_ref']['endpoint']
-        if not transfer_data.get(endpoint):
-            transfer_data[endpoint] = globus_sdk.TransferData(
-                tc, endpoint, destination['endpoint'], **transfer_kwargs
-            )
-        src = item['source_ref']['path']
-        dest = os.path.join(destination['path'], item['dest_path'])
-        is_dir = src.endswith('/')
-        if is_dir:
-            transfer_data[endpoint].add_item(src, dest, recursive=True)
-        # @HACK -- Using checksums at this point does not account for endpoints which do not
-        # support the given algorithm. This is a HUGE problem for sha256, which currently
-        # fails for any endpoint (and I'm not really sure why)
-        # Until we can properly fall back on md5 or no checksum, this should be disabled, as
-        # it effectively prevents transfers for unsupported checksums.
-        elif item.get('checksum') and False:
-            log.debug(item['checksum'])
-            transfer_data[endpoint].add_item(src, dest,
-                                             external_checksum=item['checksum']['value'],
-                                             checksum_algorithm=item['checksum']['algorithm'])
-        else:
-            transfer_data[endpoint].add_item(src, dest)
-
-    transfers = []
-    for transfer_data in transfer_data.values():
+            activations[endpoint].result()
+        except GlobusTransferException as gte:
+            failed_eps.add(endpoint)
+            errors.append({'endpoint': endpoint, 'status_code': gte.status_code,
+                           'code': gte.code, 'message': gte.detail})
+            return
+        futures[pool.submit(tc.submit_transfer, transfer_data)] = endpoint
+        if len(futures) >= workers * 2:
+            collect(wait(futures, return_when=FIRST_COMPLETED).done)
+
+    with ThreadPoolExecutor(max_workers=settings.GLOBUS_ACTIVATION_WORKERS) as activation_pool, \
+            ThreadPoolExecutor(max_workers=workers) as pool:
+        activate(dest_ep)
         try:
-            log.debug('Submitting Transfer')
-            transfers.append(tc.submit_transfer(transfer_data).data)
-        except globus_sdk.exc.TransferAPIError as tapie:
-            # Service Unavailable (503) if Globus Screws up, otherwise assume
-            # the user screwed up with a 400
-            status_code = 503 if tapie.http_status >= 500 else 400
-            if status_code == 503:
-                log.critical('Upstream Globus Transfer error!')
-                log.exception(tapie)
-            raise GlobusTransferException(tapie.message,
-                                          status_code=status_code, code=tapie.code)
-    log.debug('All transfers submitted successfully')
-    return transfers
+            for item in globus_manifest['manifest_items']:
+                endpoint = item['source_ref']['endpoint']
+                if endpoint in failed_eps:
+                    continue
+                transfer_data = batches.get(endpoint)
+                if transfer_data is None:
+                    activate(endpoint)
+                    transfer_data = batches[endpoint] = globus_sdk.TransferData(tc, endpoint, dest_ep)
+                path = item['dest_path']
+                add_transfer_item(transfer_data, item['source_ref']['path'],
+                                  path if path.startswith('/') else dest_prefix + path,
+                                  item.get('checksum'))
+                if len(transfer_data['DATA']) >= batch_size:
+                    submit(endpoint)
+            for endpoint in list(batches):
+                submit(endpoint)
+        except Exception as e:
+            # Items are read as batches are submitted, so the rest of the
+            # manifest may turn out to be unreadable after some tasks were
+            # accepted. Stop submitting, but still report those tasks.
+            if not futures and not transfers:
+                raise
+            errors.append(get_manifest_error(e))
+        collect(list(futures))
+
+    if not transfers and not errors:
+        raise NoDataToTransfer()
+    if not transfers:
+        raise GlobusTransferException(errors[0]['message'], status_code=errors[0]['status_code'],
+                                      code=errors[0]['code'])
+    if errors:
+        log.warning(f'{len(errors)} of {len(transfers) + len(errors)} transfers failed to submit')
+    else:
+        log.debug('All transfers submitted successfully')
+    return {'transfers': transfers, 'errors': errors}
+
+
+def add_transfer_item(transfer_data, src, dest, checksum=None):
+    if src.endswith('/'):
+        transfer_data.add_item(src, dest, recursive=True)
+    # @HACK -- Using checksums at this point does not account for endpoints which do not
+    # support the given algorithm. This is a HUGE problem for sha256, which currently
+    # fails for any endpoint (and I'm not really sure why)
+    # Until we can properly fall back on md5 or no checksum, this should be disabled, as
+    # it effectively prevents transfers for unsupported checksums.
+    elif checksum and False:
+        log.debug(checksum)
+        transfer_data.add_item(src, dest,
+                               external_checksum=checksum['value'],
+                               checksum_algorithm=checksum['algorithm'])
+    else:
+        transfer_data.add_item(src, dest)
+
+
+def get_submission_error(endpoint, error):
+    """Describe a failed transfer submission for the given source endpoint"""
+    if isinstance(error, globus_sdk.exc.GlobusAPIError):
+        # Service Unavailable (503) if Globus Screws up, otherwise assume
+        # the user screwed up with a 400
+        status_code = 503 if error.http_status >= 500 else 400
+        message, code = error.message, error.code
+    else:
+        status_code, message, code = 503, str(error), 'globus_unavailable'
+    if status_code == 503:
+        log.critical('Upstream Globus Transfer error!')
+        log.exception(error)
+    return {'endpoint': endpoint, 'status_code': status_code,
+            'code': code, 'message': message}
+
+
+def get_manifest_error(error):
+    """Describe an error reading a manifest partway through a transfer"""
+    log.exception(error)
+    if isinstance(error, ConciergeException):
+        return {'endpoint': None, 'status_code': error.status_code,
+                'code': error.code, 'message': str(error.detail)}
+    return {'endpoint': None, 'status_code': 500, 'code': 'manifest_unreadable',
+            'message': f'Unable to read the rest of the manifest: {error}'}
+
+
+def parse_globus_url(url):
+    """
+    Parse a Globus URL into its endpoint and path. Supports:
+    * https://<globus_endpoint>.data.globus.org/foo/bar (gcs v4)
+    * https://<globus_endpoint>.e.globus.org/ (gcs v4 — petrel)
+    * globus://<globus_endpoint>/foo/bar
+    URLs without a protocol are assumed to be http. Raises InvalidGlobusURL
+    for anything else.
+    :return: dict with the 'url', 'endpoint' and 'path'
+    """
+    match = _SIMPLE_URL.fullmatch(url) if isinstance(url, str) else None
+    if match:
+        scheme, netloc, path = match.groups()
+        scheme, path = scheme or 'http', path or ''
+    else:
+        purl = urllib.parse.urlparse(url)
+        if not purl.netloc:
+            log.debug('User specified Globus URL without protocol, '
+                      'assuming http')
+            purl = urllib.parse.urlparse(f'http://{url}')
+        scheme, netloc, path = purl.scheme, purl.netloc, purl.path
+    endpoint, error = _resolve_endpoint(scheme, netloc)
+    if error:
+        raise InvalidGlobusURL(error.format(url=url))
+    return {'url': url, 'endpoint': endpoint, 'path': path}
+
+
+@functools.lru_cache(maxsize=settings.GLOBUS_URL_CACHE_SIZE)
+def _resolve_endpoint(scheme, netloc):
+    """Find the endpoint for a URL's scheme and netloc. Manifests repeat the
+    same few endpoints, so results are cached. Returns (endpoint, error),
+    where error is a message template for the URL if it's invalid."""
+    endpoint = None
+    if scheme in ['http', 'https', '']:
+        gcs_v4_suffixes = [s for s in GCS_V4_HTTP_SUFFIXES if netloc.endswith(s)]
+        if any(gcs_v4_suffixes):
+            endpoint = netloc.replace(gcs_v4_suffixes[0], '')
+        if any(netloc.endswith(s) for s in GCS_V5_HTTP_SUFFIXES):
+            return None, 'GCS v5 HTTP Endpoints are not supported yet.'
+    elif scheme == 'globus':
+        endpoint = netloc
+    else:
+        return None, f'Protocol must be one of: {",".join(GLOBUS_URL_PROTOCOLS)} for {{url}}'
+
+    if endpoint is None:
+        return None, 'Unable to parse Globus URL: {url}'
+    try:
+        uuid.UUID(endpoint)
+    except ValueError:
+        return None, 'Globus Endpoint is not a UUID: {url}'
+    return endpoint, None
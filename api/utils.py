@@ -1,4 +1,5 @@
 from __future__ import unicode_literals
+import collections
 import datetime
 import os
 from os.path import join
@@ -6,6 +7,7 @@ import json
 import uuid
 import requests
 import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import globus_sdk
 from six.moves.urllib_parse import urlsplit
 from django.conf import settings
@@ -15,7 +17,8 @@ from bdbag import bdbag_api
 
 # from api.models import Manifest
 # from api.minid import load_minid_client
-from api.transfer import get_transfer_client
+import api.cache
+from api.transfer import get_transfer_client, autoactivate_endpoints
 from api.exc import (
     NoDataToTransfer, ConciergeException, GlobusTransferException
 )
@@ -27,65 +30,229 @@ log = logging.getLogger(__name__)
 HTTP_CHUNK_SIZE = 2**10
 
 
-def verify_remote_file_manifest(auth, remote_file_manifest):
+def verify_remote_file_manifest(auth, remote_file_manifest, progress=None):
+    """Expand every Globus record in the remote file manifest into the files
+    it references. All Globus paths are walked together by a single
+    GlobusPathWalker, so directories on different endpoints are listed
+    concurrently. Records with unsupported protocols are passed through
+    untouched. ``progress`` is passed along to the walker."""
     tc = get_transfer_client(auth)
 
-    new_manifest = []
+    walker = GlobusPathWalker(tc, progress=progress, identity=auth.user_id)
+    endpoints = set()
+    records = []
     for record in remote_file_manifest:
         surl = urlsplit(record['url'])
         if surl.scheme not in settings.SUPPORTED_STAGING_PROTOCOLS:
-            new_manifest.append(record)
+            records.append(record)
             log.debug('Verification skipped record {} (non-globus)'.format(
                 record['filename']
             ))
             continue
         globus_endpoint = surl.netloc.replace(':', '')
-        tc.endpoint_autoactivate(globus_endpoint)
-        new_man = _walk_globus_path(tc, globus_endpoint, surl.path)
-        new_manifest += new_man
+        endpoints.add(globus_endpoint)
+        records.append(walker.add(globus_endpoint, surl.path))
 
+    autoactivate_endpoints(auth, tc, endpoints)
+    results = walker.walk()
+    new_manifest = []
+    for record in records:
+        if isinstance(record, int):
+            new_manifest += results[record]
+        else:
+            new_manifest.append(record)
     return new_manifest
 
 
 def _walk_globus_path(client, globus_endpoint, path):
     """Walk the filesystem on the endpoint to find all of the files within
-    a directory. Called recursively on all dirs. Returns a list of all files
-    under the given path with the following format:
+    a directory. Returns a list of all files under the given path with the
+    following format:
     {
         'filename': 'foo.txt',
         'url': gloubs:///car/bar/foo.txt,
         'size': 123456
     }
     """
-    log.debug('Walking path to validate files: '
-              '{}:{}'.format(globus_endpoint, path))
-    ls_info = client.operation_ls(globus_endpoint, path=path)
-    # Recursion base case, return if top level is file.
-    if ls_info['DATA_TYPE'] == 'file':
-        return [{
+    walker = GlobusPathWalker(client)
+    root = walker.add(globus_endpoint, path)
+    return walker.walk()[root]
+
+
+class GlobusPathWalker(object):
+    """Breadth-first walker for directories on Globus endpoints.
+
+    Directory listings are run from a thread pool, with at most
+    settings.GLOBUS_LS_MAX_WORKERS listings in flight overall and at most
+    settings.GLOBUS_LS_MAX_PER_ENDPOINT against any single endpoint. Large
+    directories are fetched in pages of settings.GLOBUS_LS_PAGE_SIZE.
+
+    Each path given to add() is a 'root', and walk() returns the records
+    found under each root in the same format as _walk_globus_path.
+
+    ``progress`` is an optional callable which is called with the walker
+    after each directory listing completes. Long running callers can save
+    walker.get_state() there, and pick up later with
+    GlobusPathWalker.from_state() if the walk is interrupted.
+
+    Listings are served from the api.cache.ListingCache when possible, if
+    ``identity`` (the user id of the token behind ``client``) is given.
+    Subdirectories are looked up with the last_modified time from their
+    parent's listing, so a cached listing is only reused while the
+    directory is unchanged.
+    """
+
+    def __init__(self, client, progress=None, max_workers=None,
+                 max_per_endpoint=None, page_size=None, cache=None, identity=None):
+        self.client = client
+        self.identity = identity
+        # Listings can't be shared without knowing whose permissions they
+        # were fetched with
+        self.cache = (cache or api.cache.get_listing_cache()) if identity is not None else None
+        self.progress = progress
+        self.max_workers = max_workers or settings.GLOBUS_LS_MAX_WORKERS
+        self.max_per_endpoint = (max_per_endpoint or
+                                 settings.GLOBUS_LS_MAX_PER_ENDPOINT)
+        self.page_size = page_size or settings.GLOBUS_LS_PAGE_SIZE
+        # Pending directories are queued per endpoint, so a busy endpoint
+        # never holds up listings on the others.
+        self.pending = collections.OrderedDict()
+        self.results = []
+        self.dirs_listed = 0
+        # Listings currently in flight, future -> (root, endpoint, path, mtime)
+        self._running = {}
+
+    @property
+    def dirs_pending(self):
+        return sum(len(q) for q in self.pending.values())
+
+    @property
+    def files_found(self):
+        return sum(len(r) for r in self.results)
+
+    def add(self, globus_endpoint, path):
+        """Add a path to be walked, and return the root index used to look
+        up its records in the results of walk()."""
+        self.results.append([])
+        root = len(self.results) - 1
+        self._enqueue(root, globus_endpoint, path)
+        return root
+
+    def get_state(self):
+        """Return a JSON serializable snapshot of the walk. Listings which
+        are still in flight are recorded as pending."""
+        pending = [[root, ep, path, mtime]
+                   for ep, queue in self.pending.items()
+                   for root, path, mtime in queue]
+        pending += [list(task) for task in self._running.values()]
+        return {
+            'pending': pending,
+            'results': [list(files) for files in self.results],
+            'dirs_listed': self.dirs_listed,
+        }
+
+    @classmethod
+    def from_state(cls, client, state, **kwargs):
+        walker = cls(client, **kwargs)
+        walker.results = [list(files) for files in state['results']]
+        walker.dirs_listed = state['dirs_listed']
+        for root, globus_endpoint, path, mtime in state['pending']:
+            walker._enqueue(root, globus_endpoint, path, mtime)
+        return walker
+
+    def walk(self):
+        """List all pending directories, and return a list of the records
+        found under each root, in the order the roots were added. Records
+        for each root are sorted by url."""
+        in_flight = collections.Counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while self.pending or self._running:
+                for ep, queue in list(self.pending.items()):
+                    while (queue and in_flight[ep] < self.max_per_endpoint and
+                           len(self._running) < self.max_workers):
+                        root, path, mtime = queue.popleft()
+                        future = pool.submit(self._ls, ep, path, mtime)
+                        self._running[future] = (root, ep, path, mtime)
+                        in_flight[ep] += 1
+                    if not queue:
+                        del self.pending[ep]
+                done, _ = wait(self._running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    root, ep, path, _ = self._running.pop(future)
+                    in_flight[ep] -= 1
+                    self._collect(root, ep, path, future.result())
+                    self.dirs_listed += 1
+                    if self.progress:
+                        self.progress(self)
+        # Listings complete in any order, sort so the output is stable
+        for files in self.results:
+            files.sort(key=lambda record: record['url'])
+        return self.results
+
+    def _enqueue(self, root, globus_endpoint, path, mtime=None):
+        queue = self.pending.setdefault(globus_endpoint, collections.deque())
+        queue.append((root, path, mtime))
+
+    def _ls(self, globus_endpoint, path, mtime=None):
+        """Fetch the listing for a path from the cache, or from Globus if it
+        isn't cached. ``mtime`` is the last known modification time for the
+        path, if any."""
+        if self.cache is not None:
+            ls_info = self.cache.get(self.identity, globus_endpoint, path, mtime=mtime)
+            if ls_info is not None:
+                log.debug(f'Using cached listing for {globus_endpoint}:{path}')
+                return ls_info
+        ls_info = self._fetch_ls(globus_endpoint, path)
+        if self.cache is not None:
+            self.cache.set(self.identity, globus_endpoint, path, ls_info, mtime=mtime)
+        return ls_info
+
+    def _fetch_ls(self, globus_endpoint, path):
+        """Fetch the full listing for a path, following pages if the
+        directory is larger than the page size."""
+        log.debug('Walking path to validate files: '
+                  '{}:{}'.format(globus_endpoint, path))
+        offset, data = 0, []
+        while True:
+            ls_info = self.client.operation_ls(globus_endpoint, path=path,
+                                               offset=offset,
+                                               limit=self.page_size)
+            if ls_info['DATA_TYPE'] == 'file':
+                return {'DATA_TYPE': 'file', 'path': ls_info['path'],
+                        'size': ls_info['size']}
+            page = ls_info['DATA']
+            data += page
+            offset += len(page)
+            total = ls_info.get('total', offset + 1)
+            if len(page) < self.page_size or offset >= total:
+                return {'DATA_TYPE': ls_info['DATA_TYPE'], 'DATA': data}
+
+    def _collect(self, root, globus_endpoint, path, ls_info):
+        files = self.results[root]
+        # Base case, the root itself was a file
+        if ls_info['DATA_TYPE'] == 'file':
+            files.append({
                 'url': 'globus://{}:{}'.format(globus_endpoint,
                                                ls_info['path']),
                 'filename': join(path, ls_info['path']),
-                'size': ls_info['size']}]
-    # Loop through all files in the 'ls', capture data, and recurse again if
-    # we encounter a folder.
-    files = []
-    for file in ls_info['DATA']:
-        if file['type'] == 'file':
-            files.append({
-                'url': 'globus://{}:{}'.format(globus_endpoint,
-                                               join(path, file['name'])),
-                'filename': file['name'],
-                'size': file['size']})
-        elif file['type'] == 'dir':
-            files += _walk_globus_path(client, globus_endpoint,
-                                       join(path, file['name']))
-        else:
-            log.warning('Encountered strange file type while validating path '
-                        '"{}:{}" File data: {}'.format(globus_endpoint, path,
-                                                       file))
-            continue
-    return files
+                'size': ls_info['size']})
+            return
+        # Capture data for all files in the 'ls', and queue up any folders
+        # we encounter for listing.
+        for file in ls_info['DATA']:
+            if file['type'] == 'file':
+                files.append({
+                    'url': 'globus://{}:{}'.format(globus_endpoint,
+                                                   join(path, file['name'])),
+                    'filename': file['name'],
+                    'size': file['size']})
+            elif file['type'] == 'dir':
+                self._enqueue(root, globus_endpoint, join(path, file['name']),
+                              mtime=file.get('last_modified'))
+            else:
+                log.warning('Encountered strange file type while validating '
+                            'path "{}:{}" File data: {}'.format(
+                                globus_endpoint, path, file))
 
 
 def create_unique_folder():
@@ -224,10 +391,10 @@ def transfer_catalog(auth, transfer_manifest, dest_endpoint, dest_prefix,
     # activate all endpoints before transfer
     #
     tc = get_transfer_client(auth)
-    tc.endpoint_autoactivate(dest_endpoint)
     if not transfer_manifest:
         raise ConciergeException('No valid data to transfer',
                                  code='no_data')
+    autoactivate_endpoints(auth, tc, [dest_endpoint, *transfer_manifest])
     try:
         log.debug(f'Testing {dest_endpoint}{dest_prefix}')
         tc.operation_ls(dest_endpoint, path=dest_prefix)
@@ -240,7 +407,6 @@ def transfer_catalog(auth, transfer_manifest, dest_endpoint, dest_prefix,
                   .format(auth.user, globus_source_endpoint, dest_endpoint,
                           dest_prefix,
                           len(data_list)))
-        tc.endpoint_autoactivate(globus_source_endpoint)
         tdata = globus_sdk.TransferData(tc,
                                         globus_source_endpoint,
                                         dest_endpoint,
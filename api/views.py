@@ -1,14 +1,22 @@
 from __future__ import unicode_literals
 import logging
+import uuid
 from django.contrib.auth import logout as django_logout
 from django.shortcuts import redirect
 from django.core.exceptions import ValidationError
-from rest_framework import viewsets, permissions, response
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.dateparse import parse_datetime
+import globus_sdk
+from rest_framework import exceptions, viewsets, permissions, response
 from rest_framework.request import Request
 from rest_framework.response import Response
 from gap.views import ActionViewSet
-from api.models import Manifest, ManifestTransfer
+import api.manifest
+from api.models import Manifest, ManifestTransfer, Transfer
 from api.auth import GlobusSessionAuthentication, IsOwnerOrReadOnly, IsOwner
+from api.pagination import CreatedCursorPagination
+from api.streaming import can_stream, get_content_encoding, streaming_json_response
 from api.transfer import get_transfer_client
 
 from api.serializers.manifest import ManifestListSerializer, ManifestTransferSerializer
@@ -28,17 +36,54 @@ class ManifestViewSet(viewsets.ModelViewSet):
     delete: Delete a manifest. Only allowed by owner.
     """
     serializer_class = ManifestListSerializer
-    queryset = Manifest.objects.all()
+    queryset = Manifest.objects.select_related('user')
     permission_classes = (IsOwnerOrReadOnly,)
+    pagination_class = CreatedCursorPagination
     http_method_names = ['head', 'get', 'post', 'delete']
 
-    # def retrieve(self, request, *args, **kwargs):
-    #     log.debug(request, args, kwargs)
-    #     return super().retrieve(request, *args, **kwargs)
+    def get_queryset(self):
+        """Listings can be filtered with the query params ``user`` (username),
+        ``created_after`` and ``created_before``."""
+        queryset = super().get_queryset()
+        if self.action != 'list':
+            return queryset
+        params = self.request.query_params
+        if params.get('user'):
+            queryset = queryset.filter(user__username=params['user'])
+        return filter_created(queryset, params)
+
+    def retrieve(self, request, *args, **kwargs):
+        """Manifest entries are streamed from storage rather than rendered
+        in one piece, see api.streaming. Manifests never change, so streamed
+        manifests can be cached by clients, and requests with a matching
+        If-None-Match get a 304 without touching storage."""
+        instance = self.get_object()
+        serializer = self.get_serializer(instance)
+        field_name = next((f for f in ('manifest_items', 'remote_file_manifest')
+                           if f in serializer.fields), None)
+        if field_name is None or not can_stream(request):
+            return Response(serializer.data)
+        etag = api.manifest.get_etag(instance.id, field_name, get_content_encoding(request),
+                                     fields=list(serializer.fields))
+        resp = get_conditional_response(request, etag=etag)
+        if resp is None:
+            entries = api.manifest.open_remote_file_manifest(instance.id)
+            if field_name == 'manifest_items':
+                entries = api.manifest.iter_rfm_to_gm(entries)
+            resp = streaming_json_response(request, serializer, field_name, entries)
+        resp['ETag'] = etag
+        patch_cache_control(resp, public=True, immutable=True,
+                            max_age=settings.MANIFEST_HTTP_CACHE_MAX_AGE)
+        patch_vary_headers(resp, ('Accept', 'Accept-Encoding'))
+        return resp
 
     def delete(self, request, *args, **kwargs):
         return self.destroy(request, *args, **kwargs)
 
+    def perform_destroy(self, instance):
+        super().perform_destroy(instance)
+        api.manifest.invalidate_manifest(instance.id)
+
 
 class TransferViewSet(viewsets.ModelViewSet):
     """
@@ -48,12 +93,33 @@ class TransferViewSet(viewsets.ModelViewSet):
     """
     serializer_class = ManifestTransferSerializer
     permission_classes = (permissions.IsAuthenticated, IsOwner)
-    queryset = ManifestTransfer.objects.all()
+    queryset = ManifestTransfer.objects.select_related('user').prefetch_related('transfers')
+    pagination_class = CreatedCursorPagination
     http_method_names = ['head', 'get', 'post']
 
+    def get_queryset(self):
+        """Users only see their own transfers. Listings can be filtered with
+        the query params ``manifest_id``, ``created_after`` and
+        ``created_before``."""
+        queryset = super().get_queryset().filter(user=self.request.user)
+        params = self.request.query_params
+        if params.get('manifest_id'):
+            try:
+                queryset = queryset.filter(manifest_id=uuid.UUID(params['manifest_id']))
+            except ValueError:
+                raise exceptions.ValidationError({'manifest_id': 'Must be a UUID'})
+        return filter_created(queryset, params)
+
     def get_object(self):
-        return ManifestTransfer.objects.get(manifest=self.kwargs['manifest_id'],
-                                            id=self.kwargs['manifest_transfer_id'])
+        obj = self.get_queryset().get(manifest=self.kwargs['manifest_id'],
+                                      id=self.kwargs['manifest_transfer_id'])
+        refresh_stale_transfers(self.request.auth, obj.transfers.all())
+        return obj
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+        refresh_stale_transfers(self.request.auth, [t for mt in page or () for t in mt.transfers.all()])
+        return page
 
     def retrieve(self, response, *args, **kwargs):
         # if self.kwargs.get('manifest_id') and self.kwargs.get('manifest_transfer_id'):
@@ -87,31 +153,62 @@ class TransferManifestActionViewSet(ActionViewSet):
     body_serializer_class = detail_serializer_class = ManifestTransferActionSerializer
 
     def cancel(self, request, action_id):
-        obj = self.get_manifest(action_id)
+        obj = self.get_details_object(action_id)
         if obj.action.display_status != 'ACTIVE':
             return self.status(request, action_id)
         tc = get_transfer_client(request.auth)
-        tc.cancel_task(str(obj.transfer.task_id))
-        return super().cancel(request, action_id)
+        transfers = [t for t in obj.transfers.all() if t.status not in Transfer.TERMINAL_STATES]
+        for transfer in transfers:
+            tc.cancel_task(str(transfer.task_id))
+        Transfer.update_many(request.auth, transfers)
+        return self.status(request, action_id)
 
     def status(self, request, action_id=None):
         obj = self.get_details_object(action_id)
         action = obj.action
         if action.display_status in ['INACTIVE', 'ACTIVE']:
-            for transfer in obj.transfers.all():
-                log.debug(f'Updating Transfer {transfer}')
-                transfer.update()
-            tstatus = [t.status for t in obj.transfers.all()]
-            if 'FAILED' in tstatus:
+            refresh_stale_transfers(request.auth, obj.transfers.all())
+            # Endpoints which failed to submit also count as FAILED
+            transfer_status = obj.status
+            if transfer_status == 'FAILED':
                 action.status = ActionStatusValue.FAILED
                 action.display_status = ActionStatusValue.FAILED.name
-            elif all((s == 'SUCCEEDED') for s in tstatus):
+            elif transfer_status == 'SUCCEEDED':
                 action.status = ActionStatusValue.SUCCEEDED.name
                 action.display_status = ActionStatusValue.SUCCEEDED.name
             action.save()
         return super().status(request, action_id)
 
 
+def refresh_stale_transfers(auth, transfers):
+    """Transfer statuses are kept up to date by api.poller. If the poller
+    has fallen behind (or isn't running), refresh stale transfers as they
+    are read. Failures are logged, the stored statuses are still returned."""
+    stale = [t for t in transfers if t.is_stale]
+    if not stale or auth is None:
+        return
+    log.debug(f'Refreshing {len(stale)} stale transfers')
+    try:
+        Transfer.update_many(auth, stale)
+    except globus_sdk.exc.GlobusError as ge:
+        log.warning(f'Unable to refresh stale transfers: {ge}')
+
+
+def filter_created(queryset, params):
+    """Filter a queryset by the ``created_after`` and ``created_before``
+    query params, given as ISO 8601 datetimes"""
+    for param, lookup in (('created_after', 'created__gte'), ('created_before', 'created__lt')):
+        if params.get(param):
+            try:
+                created = parse_datetime(params[param])
+            except ValueError:
+                created = None
+            if created is None:
+                raise exceptions.ValidationError({param: 'Must be an ISO 8601 datetime'})
+            queryset = queryset.filter(**{lookup: created})
+    return queryset
+
+
 def logout(request, next='/'):
     """
     Revoke the users tokens and pop their Django session. Users will be
@@ -33,9 +33,83 @@ AWS_BUCKET_NAME = os.getenv('AWS_BUCKET_NAME', 'fair-research-concierge')
 AWS_FOLDER = os.getenv('AWS_FOLDER', 'manifests')
 AWS_FOLDER_TEST = os.getenv('AWS_FOLDER_TEST', 'manifests-dev')
 AWS_STAGING_DIR = os.getenv('AWS_STAGING_DIR', '/tmp/concierge_staging')
+# S3 connection pool size per worker process, and multipart transfer tuning
+AWS_S3_MAX_POOL_CONNECTIONS = int(os.getenv('AWS_S3_MAX_POOL_CONNECTIONS', 20))
+AWS_S3_MULTIPART_THRESHOLD = int(os.getenv('AWS_S3_MULTIPART_THRESHOLD', 8 * 2**20))
+AWS_S3_MULTIPART_CHUNKSIZE = int(os.getenv('AWS_S3_MULTIPART_CHUNKSIZE', 8 * 2**20))
+AWS_S3_MAX_CONCURRENCY = int(os.getenv('AWS_S3_MAX_CONCURRENCY', 10))
+# Max bytes of manifests kept in AWS_STAGING_DIR. Least recently used
+# manifests are removed past this, down to AWS_STAGING_LOW_WATER of the max.
+AWS_STAGING_MAX_BYTES = int(os.getenv('AWS_STAGING_MAX_BYTES', 10 * 2**30))
+AWS_STAGING_LOW_WATER = 0.9
+# gzip level for stored manifests, 1 (fastest) to 9 (smallest)
+MANIFEST_COMPRESSION_LEVEL = int(os.getenv('MANIFEST_COMPRESSION_LEVEL', 6))
+# New manifests are uploaded to S3 in the background, retrying failed
+# uploads with exponential backoff starting at MANIFEST_UPLOAD_BACKOFF secs
+MANIFEST_UPLOAD_ASYNC = os.getenv('MANIFEST_UPLOAD_ASYNC', 'True') == 'True'
+MANIFEST_UPLOAD_WORKERS = int(os.getenv('MANIFEST_UPLOAD_WORKERS', 4))
+MANIFEST_UPLOAD_RETRIES = int(os.getenv('MANIFEST_UPLOAD_RETRIES', 5))
+MANIFEST_UPLOAD_BACKOFF = float(os.getenv('MANIFEST_UPLOAD_BACKOFF', 1))
+# Parsed manifests are cached in memory by each worker, up to this many
+# bytes (or manifest entries, if MANIFEST_CACHE_SIZE_UNIT is 'entries'). An
+# entry takes roughly 1KB in memory. Only manifests with at most
+# MANIFEST_CACHE_MAX_ENTRIES entries are cached when they are streamed.
+MANIFEST_CACHE_MAX_SIZE = int(os.getenv('MANIFEST_CACHE_MAX_SIZE', 32 * 2**20))
+MANIFEST_CACHE_SIZE_UNIT = os.getenv('MANIFEST_CACHE_SIZE_UNIT', 'bytes')
+MANIFEST_CACHE_MAX_ENTRIES = int(os.getenv('MANIFEST_CACHE_MAX_ENTRIES', 10000))
+# Manifests with at least this many entries are checked with a compiled
+# validator (see api.serializers.validation)
+MANIFEST_FAST_VALIDATION_THRESHOLD = int(os.getenv('MANIFEST_FAST_VALIDATION_THRESHOLD', 1000))
+# Manifests are streamed to clients in chunks of MANIFEST_STREAM_CHUNK_SIZE
+# entries, gzipped for clients which accept it if MANIFEST_STREAM_GZIP is on
+MANIFEST_STREAM_CHUNK_SIZE = int(os.getenv('MANIFEST_STREAM_CHUNK_SIZE', 1000))
+MANIFEST_STREAM_GZIP = os.getenv('MANIFEST_STREAM_GZIP', 'True') == 'True'
+# Seconds clients and proxies may cache streamed manifests for
+MANIFEST_HTTP_CACHE_MAX_AGE = int(os.getenv('MANIFEST_HTTP_CACHE_MAX_AGE', 60 * 60 * 24 * 365))
 
 # Globus
 GLOBUS_DEFAULT_SYNC_LEVEL = 'checksum'
+# Directory listings used when verifying remote file manifests. Listings run
+# concurrently, with a separate cap per endpoint so no single endpoint gets
+# flooded with 'ls' requests.
+GLOBUS_LS_MAX_WORKERS = int(os.getenv('GLOBUS_LS_MAX_WORKERS', 16))
+GLOBUS_LS_MAX_PER_ENDPOINT = int(os.getenv('GLOBUS_LS_MAX_PER_ENDPOINT', 4))
+GLOBUS_LS_PAGE_SIZE = int(os.getenv('GLOBUS_LS_PAGE_SIZE', 100000))
+# Seconds directory listings are cached for, set to 0 to disable. The cache
+# is bounded by the total number of entries in all cached listings. Set
+# GLOBUS_LS_CACHE_SHARED to the name of a Django cache in CACHES to share
+# listings between workers.
+GLOBUS_LS_CACHE_TTL = int(os.getenv('GLOBUS_LS_CACHE_TTL', 300))
+GLOBUS_LS_CACHE_MAX_ENTRIES = int(os.getenv('GLOBUS_LS_CACHE_MAX_ENTRIES', 1000000))
+GLOBUS_LS_CACHE_SHARED = os.getenv('GLOBUS_LS_CACHE_SHARED')
+# Endpoint auto-activations are cached per user until
+# GLOBUS_ACTIVATION_EXPIRY_MARGIN seconds before they expire, and for no more
+# than GLOBUS_ACTIVATION_CACHE_MAX_TTL seconds
+GLOBUS_ACTIVATION_CACHE_SIZE = int(os.getenv('GLOBUS_ACTIVATION_CACHE_SIZE', 10000))
+GLOBUS_ACTIVATION_CACHE_MAX_TTL = int(os.getenv('GLOBUS_ACTIVATION_CACHE_MAX_TTL', 60 * 60))
+GLOBUS_ACTIVATION_EXPIRY_MARGIN = int(os.getenv('GLOBUS_ACTIVATION_EXPIRY_MARGIN', 60 * 5))
+GLOBUS_ACTIVATION_WORKERS = int(os.getenv('GLOBUS_ACTIVATION_WORKERS', 8))
+# Manifests are transferred in tasks of up to GLOBUS_TRANSFER_BATCH_SIZE
+# items each, with up to GLOBUS_TRANSFER_SUBMIT_WORKERS submitted at once
+GLOBUS_TRANSFER_BATCH_SIZE = int(os.getenv('GLOBUS_TRANSFER_BATCH_SIZE', 10000))
+GLOBUS_TRANSFER_SUBMIT_WORKERS = int(os.getenv('GLOBUS_TRANSFER_SUBMIT_WORKERS', 8))
+# Number of URL hosts to remember when parsing Globus URLs
+GLOBUS_URL_CACHE_SIZE = int(os.getenv('GLOBUS_URL_CACHE_SIZE', 4096))
+# Task status is fetched in bulk with up to GLOBUS_TASK_LIST_BATCH_SIZE task ids
+# per request, falling back to GLOBUS_TASK_FETCH_WORKERS concurrent requests
+GLOBUS_TASK_LIST_BATCH_SIZE = int(os.getenv('GLOBUS_TASK_LIST_BATCH_SIZE', 50))
+GLOBUS_TASK_FETCH_WORKERS = int(os.getenv('GLOBUS_TASK_FETCH_WORKERS', 8))
+# Transfer status is refreshed by the poller (manage.py poll_transfers), which
+# checks for due transfers every TRANSFER_POLL_TICK seconds. Each transfer is
+# polled at an interval of TRANSFER_POLL_AGE_FACTOR times its age, within the
+# min and max intervals below.
+TRANSFER_POLL_TICK = float(os.getenv('TRANSFER_POLL_TICK', 5))
+TRANSFER_POLL_AGE_FACTOR = float(os.getenv('TRANSFER_POLL_AGE_FACTOR', 0.1))
+TRANSFER_POLL_MIN_INTERVAL = float(os.getenv('TRANSFER_POLL_MIN_INTERVAL', 10))
+TRANSFER_POLL_MAX_INTERVAL = float(os.getenv('TRANSFER_POLL_MAX_INTERVAL', 60 * 30))
+# Automate status checks refresh transfers inline if the poller hasn't
+# reached them in this many seconds past when they were due
+TRANSFER_POLL_STALE_AFTER = float(os.getenv('TRANSFER_POLL_STALE_AFTER', 60 * 5))
 
 # Bag Settings
 BAG_STAGING_DIR = '/tmp/bag_staging'
@@ -52,6 +126,14 @@ CONCIERGE_SCOPE = ('https://auth.globus.org/scopes/'
                    '524361f2-e4a9-4bd0-a3a6-03e365cac8a9/concierge')
 TRANSFER_SCOPE = 'urn:globus:auth:scope:transfer.api.globus.org:all'
 
+# Globus SDK clients share one pool of keep-alive connections per process
+GLOBUS_HTTP_POOL_CONNECTIONS = int(os.getenv('GLOBUS_HTTP_POOL_CONNECTIONS', 10))
+GLOBUS_HTTP_POOL_MAXSIZE = int(os.getenv('GLOBUS_HTTP_POOL_MAXSIZE', 20))
+# Seconds to wait on Globus Auth before giving up on a request
+GLOBUS_AUTH_HTTP_TIMEOUT = float(os.getenv('GLOBUS_AUTH_HTTP_TIMEOUT', 30))
+# Max number of tokens to cache transfer clients for in each process
+GLOBUS_TRANSFER_CLIENT_CACHE_SIZE = int(os.getenv('GLOBUS_TRANSFER_CLIENT_CACHE_SIZE', 1000))
+
 GLOBUS_KEY = os.getenv('GLOBUS_KEY', '')
 GLOBUS_SECRET = os.getenv('GLOBUS_SECRET', '')
 SOCIAL_AUTH_GLOBUS_KEY = GLOBUS_KEY
@@ -95,6 +177,9 @@ REST_FRAMEWORK = {
     ],
     'EXCEPTION_HANDLER': 'api.exception_handlers.concierge_exception_handler',
 }
+# Manifest and transfer listings are paginated, see api.pagination
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 100))
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 1000))
 
 AUTHENTICATION_BACKENDS = (
    'social_core.backends.globus.GlobusOpenIdConnect',
@@ -105,6 +190,23 @@ LOGIN_URL = '/login/globus/'
 LOGOUT_URL = '/logout/'
 # Seconds for which a token can be used in-between introspections
 GLOBUS_INTROSPECTION_CACHE_EXPIRATION = 30
+# Introspected tokens are kept in memory for the introspection window above,
+# up to GLOBUS_TOKEN_CACHE_SIZE tokens. Set GLOBUS_TOKEN_CACHE_SHARED to the
+# name of a Django cache in CACHES to share them between workers.
+GLOBUS_TOKEN_CACHE_SIZE = int(os.getenv('GLOBUS_TOKEN_CACHE_SIZE', 10000))
+GLOBUS_TOKEN_CACHE_SHARED = os.getenv('GLOBUS_TOKEN_CACHE_SHARED')
+# Workers sharing GLOBUS_TOKEN_CACHE_SHARED wait up to this many seconds for
+# another worker introspecting the same token
+GLOBUS_INTROSPECTION_LOCK_TIMEOUT = int(os.getenv('GLOBUS_INTROSPECTION_LOCK_TIMEOUT', 10))
+# Dependent tokens are refreshed in the background when they expire within
+# GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN seconds. Offline dependent tokens come
+# with refresh tokens, which are used to refresh them.
+GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN = int(os.getenv('GLOBUS_DEPENDENT_TOKEN_REFRESH_MARGIN', 60 * 10))
+GLOBUS_DEPENDENT_TOKEN_REFRESH_WORKERS = int(os.getenv('GLOBUS_DEPENDENT_TOKEN_REFRESH_WORKERS', 2))
+GLOBUS_DEPENDENT_TOKENS_OFFLINE = os.getenv('GLOBUS_DEPENDENT_TOKENS_OFFLINE', 'True') == 'True'
+# Dependent tokens which don't report when they expire are refetched after
+# this many seconds
+GLOBUS_DEPENDENT_TOKEN_DEFAULT_LIFETIME = int(os.getenv('GLOBUS_DEPENDENT_TOKEN_DEFAULT_LIFETIME', 60 * 60 * 48))
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
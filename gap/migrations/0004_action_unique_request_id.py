@@ -0,0 +1,34 @@
+# Generated by Django 3.0.8 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+def clear_duplicate_request_ids(apps, schema_editor):
+    """Keep the request_id on the earliest action for each user, and clear
+    it on any later duplicates so the unique constraint can be added."""
+    Action = apps.get_model('gap', 'Action')
+    seen = set()
+    actions = (Action.objects.exclude(request_id__isnull=True)
+               .order_by('creator_id', 'request_id', 'start_time')
+               .values_list('action_id', 'creator_id', 'request_id'))
+    duplicates = []
+    for action_id, creator_id, request_id in actions.iterator():
+        if (creator_id, request_id) in seen:
+            duplicates.append(action_id)
+        seen.add((creator_id, request_id))
+    Action.objects.filter(action_id__in=duplicates).update(request_id=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gap', '0003_auto_20201104_2119'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_duplicate_request_ids, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='action',
+            constraint=models.UniqueConstraint(fields=('creator', 'request_id'), name='gap_action_unique_request_id'),
+        ),
+    ]
@@ -30,6 +30,13 @@ class Action(models.Model):
     completion_time = models.DateTimeField(max_length=256, null=True)
     release_after = models.IntegerField(default=DEFAULT_RELEASE_AFTER)
 
+    class Meta:
+        # Also serves as the index for looking up replayed requests in run()
+        constraints = [
+            models.UniqueConstraint(fields=['creator', 'request_id'],
+                                    name='gap_action_unique_request_id'),
+        ]
+
     @property
     def body(self):
         """This is a bit of a hack, since the create serializer expects Actions
@@ -3,6 +3,7 @@ Serializers for the Globus Automate Spec
 https://action-provider-tools.readthedocs.io/en/latest/action_provider_interface.html  # noqa
 """
 import logging
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 from rest_framework_dataclasses.serializers import DataclassSerializer
 from globus_action_provider_tools.data_types import ActionStatusValue, ActionStatus, ActionRequest
@@ -15,6 +16,10 @@ log = logging.getLogger(__name__)
 THIRTY_DAYS = 60 * 60 * 24 * 30
 
 
+class DuplicateRequestId(Exception):
+    """The user already has an action with this request_id"""
+
+
 class ActionCreateSerializer(DataclassSerializer, serializers.ModelSerializer):
     request_id = serializers.CharField(required=False)
     release_after = serializers.CharField(required=False, default=THIRTY_DAYS)
@@ -26,13 +31,21 @@ class ActionCreateSerializer(DataclassSerializer, serializers.ModelSerializer):
         model = gap.models.Action
 
     def create(self, validated_data):
-        action = gap.models.Action.objects.create(
-            request_id=validated_data.request_id,
-            creator=self.context['request'].user,
-            status=ActionStatusValue.INACTIVE,
-            display_status=ActionStatusValue.INACTIVE.name,
-            release_after=validated_data.release_after,
-        )
+        # The action is saved before any work starts, so a replayed request_id
+        # raises DuplicateRequestId here instead of starting the work twice.
+        try:
+            with transaction.atomic():
+                action = gap.models.Action.objects.create(
+                    request_id=validated_data.request_id,
+                    creator=self.context['request'].user,
+                    status=ActionStatusValue.INACTIVE,
+                    display_status=ActionStatusValue.INACTIVE.name,
+                    release_after=validated_data.release_after,
+                )
+        except IntegrityError:
+            if validated_data.request_id is None:
+                raise
+            raise DuplicateRequestId(validated_data.request_id)
         # Get the serializer for the 'body' object, or the object which has been
         # set for doing the work.
         body_serializer_cls = self.context['view'].body_serializer_class
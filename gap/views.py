@@ -5,7 +5,7 @@ from rest_framework.response import Response
 from gap.models import Action
 from rest_framework.schemas.openapi import SchemaGenerator
 from gap import permissions
-from gap.serializers import ActionCreateSerializer, ActionStatusSerializer
+from gap.serializers import ActionCreateSerializer, ActionStatusSerializer, DuplicateRequestId
 
 log = logging.getLogger(__name__)
 
@@ -84,15 +84,24 @@ class ActionViewSet(viewsets.ModelViewSet):
         return self.details_object.objects.get(action_id=action_id)
 
     def run(self, request):
+        """Run an action. Runs are idempotent on request_id, a request_id
+        which the user has already run returns the status of that action."""
         request_id = request.data.get('request_id')
         if request_id:
             log.debug(f'Found request_id {request_id} for user {request.user}')
-            try:
-                previous_action = Action.objects.get(request_id=request_id, creator=request.user)
+            previous_action = self.get_previous_action(request_id)
+            if previous_action is not None:
                 return Response(self.status_serializer_class(previous_action).data)
-            except Action.DoesNotExist:
-                pass
-        return self.create(request)
+        try:
+            return self.create(request)
+        except DuplicateRequestId:
+            # A concurrent run with the same request_id created it first
+            log.debug(f'Lost race to run request_id {request_id} for user {request.user}')
+            previous_action = self.get_previous_action(request_id)
+            return Response(self.status_serializer_class(previous_action).data)
+
+    def get_previous_action(self, request_id):
+        return Action.objects.filter(request_id=request_id, creator=self.request.user).first()
 
     def introspect(self, request):
         """